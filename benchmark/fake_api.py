@@ -0,0 +1,171 @@
+import os, json, time, threading, itertools, email
+import libtorrent as lt
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+
+
+class FakeBotApi:
+    def __init__(self, port: int, seed_port: int):
+        self.seed_port = seed_port
+        self.users = {}
+        self.requests = {}
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._files = {}
+        self._condition = threading.Condition()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+    def add_user(self, user):
+        self.users[user.id] = user
+
+    def send_document(self, user, path: str):
+        file_id = f"torrent-{user.id}"
+        self._files[file_id] = path
+        self._push({"message": {
+            **self._message(user.id, user.profile),
+            "document": {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_name": os.path.basename(path),
+                "mime_type": "application/x-bittorrent",
+                "file_size": os.path.getsize(path),
+            },
+        }})
+
+    def press(self, user, message: dict, data: str):
+        self._push({"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": user.profile,
+            "chat_instance": str(user.id),
+            "message": message,
+            "data": data,
+        }})
+
+    def _push(self, update: dict):
+        with self._condition:
+            self._updates.append({"update_id": next(self._update_ids), **update})
+            self._condition.notify_all()
+
+    def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._condition:
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return list(self._updates)
+
+    def _message(self, chat_id, sender=BOT_USER, message_id=None, **fields) -> dict:
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": sender,
+            **fields,
+        }
+
+    def _call(self, method: str, params: dict, files: dict):
+        self.requests[method] = self.requests.get(method, 0) + 1
+        chat_id = params.get("chat_id")
+        markup = json.loads(params["reply_markup"]) if isinstance(params.get("reply_markup"), str) else params.get("reply_markup")
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "getFile":
+            path = self._files[params["file_id"]]
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_size": os.path.getsize(path), "file_path": path}
+        if method in ("sendMessage", "editMessageText", "editMessageCaption", "editMessageReplyMarkup", "sendVideo"):
+            fields = {"text": params.get("text")} if "text" in params else {"caption": params.get("caption")}
+            if markup and "inline_keyboard" in markup:
+                fields["reply_markup"] = markup
+            if method == "sendVideo":
+                size = len(files["video"]) if "video" in files else self._local_size(params.get("video"))
+                fields["video"] = {
+                    "file_id": f"video-{next(self._message_ids)}",
+                    "file_unique_id": f"video-{next(self._message_ids)}",
+                    "width": int(params.get("width") or 0),
+                    "height": int(params.get("height") or 0),
+                    "duration": int(float(params.get("duration") or 0)),
+                    "file_size": size,
+                }
+            message = self._message(chat_id, message_id=params.get("message_id"), **fields)
+            user = self.users.get(int(chat_id))
+            if user:
+                user.receive(self, method, message)
+            return message
+        return True
+
+    def _local_size(self, video):
+        if isinstance(video, str) and video.startswith("file://"):
+            return os.path.getsize(urlparse(video).path)
+        return 0
+
+    def _announce(self) -> bytes:
+        peers = bytes([127, 0, 0, 1]) + self.seed_port.to_bytes(2, "big")
+        return lt.bencode({"interval": 60, "peers": peers})
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                if urlparse(self.path).path == "/announce":
+                    self._reply(api._announce(), "text/plain")
+                else:
+                    self._reply(b"", "text/plain", 404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                method = urlparse(self.path).path.rstrip("/").split("/")[-1]
+                params, files = parse_body(self.headers.get("Content-Type") or "", body)
+                try:
+                    result = {"ok": True, "result": api._call(method, params, files)}
+                except Exception as e:
+                    result = {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+                self._reply(json.dumps(result).encode(), "application/json")
+
+            def _reply(self, data: bytes, content_type: str, status=200):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+def parse_body(content_type: str, body: bytes):
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}"), {}
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params, files = {}, {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            if part.get_filename():
+                files[name] = payload
+            else:
+                params[name] = payload.decode()
+        for name, value in list(params.items()):
+            if value.startswith("attach://"):
+                files[name] = files.get(value.removeprefix("attach://"), b"")
+                del params[name]
+        return params, files
+    return {key: values[-1] for key, values in parse_qs(body.decode()).items()}, {}
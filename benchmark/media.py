@@ -0,0 +1,72 @@
+import os, ffmpeg
+import libtorrent as lt
+
+ENCODERS = {"h264": "libx264", "hevc": "libx265", "mpeg4": "mpeg4", "vp9": "libvpx-vp9"}
+
+
+def make_fixtures(folder: str, count: int, duration: int, size: str, codecs: list[str], audio_tracks: int, container="mkv") -> list[str]:
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(count):
+        codec = codecs[i % len(codecs)]
+        path = os.path.join(folder, f"ep{i + 1:02d}-{codec}-{size}-{duration}s-{audio_tracks}a.{container}")
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        video = ffmpeg.input(f"testsrc2=size={size}:rate=25:duration={duration}", f="lavfi")
+        audios = [
+            ffmpeg.input(f"sine=frequency={220 * (track + 1)}:duration={duration}", f="lavfi")
+            for track in range(audio_tracks)
+        ]
+        # MP4 fixtures get faststart, like files that are ready to send as they are
+        faststart = {"movflags": "+faststart"} if container == "mp4" else {}
+        ffmpeg.output(
+            video, *audios, f"{path}.tmp.{container}",
+            vcodec=ENCODERS.get(codec, codec), acodec="aac", pix_fmt="yuv420p", g=50, **faststart,
+        ).overwrite_output().run(quiet=True)
+        os.replace(f"{path}.tmp.{container}", path)
+    return paths
+
+
+def make_user_torrent(folder: str, name: str, fixtures: list[str], tracker: str) -> str:
+    content = os.path.join(folder, name)
+    os.makedirs(content, exist_ok=True)
+    for fixture in fixtures:
+        link = os.path.join(content, os.path.basename(fixture).split("-")[0] + os.path.splitext(fixture)[1])
+        if not os.path.exists(link):
+            os.link(fixture, link)
+    # A unique extra file gives every user a different infohash, so nothing is served from the caches
+    with open(os.path.join(content, f"{name}.nfo"), "w") as f:
+        f.write(name)
+
+    storage = lt.file_storage()
+    lt.add_files(storage, content)
+    creator = lt.create_torrent(storage)
+    creator.add_tracker(tracker)
+    lt.set_piece_hashes(creator, folder)
+    path = os.path.join(folder, f"{name}.torrent")
+    with open(path, "wb") as f:
+        f.write(lt.bencode(creator.generate()))
+    return path
+
+
+class Seeder:
+    def __init__(self, port: int):
+        self.port = port
+        self.session = lt.session({
+            "listen_interfaces": f"127.0.0.1:{port}",
+            "enable_dht": False,
+            "enable_lsd": False,
+            "enable_upnp": False,
+            "enable_natpmp": False,
+            "active_seeds": -1,
+            "active_limit": -1,
+            "allow_multiple_connections_per_ip": True,
+        })
+
+    def seed(self, torrent_path: str):
+        params = lt.add_torrent_params()
+        params.ti = lt.torrent_info(torrent_path)
+        params.save_path = os.path.dirname(torrent_path)
+        params.flags |= lt.torrent_flags.seed_mode
+        self.session.add_torrent(params)
@@ -0,0 +1,238 @@
+import os, sys, json, time, shutil, signal, argparse, resource, statistics, subprocess, threading, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_api import FakeBotApi
+from media import make_fixtures, make_user_torrent, Seeder
+from cache import folder_size
+
+# Buttons pressed by the simulated users, in flow order
+FLOW_BUTTONS = ("accept:yes", "audio:", "sample:yes", "upload:yes", "remove:yes")
+# Button that ends the audio track selection, by --audio choice, followed by the job id
+AUDIO_CONTINUE = {"first": "audio:done", "tracks": "audio:tracks", "files": "audio:files"}
+STAGES = ("preview", "download", "sample", "upload", "total")
+
+
+class User:
+    def __init__(self, user_id: int, think: float, audio="first"):
+        self.id = user_id
+        self.think = think
+        self.audio = audio
+        self.profile = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+        self.events = {}
+        self.videos = 0
+        self.video_bytes = 0
+        self.pressed = set()
+        self.done = threading.Event()
+
+    def mark(self, event: str):
+        self.events.setdefault(event, time.monotonic())
+
+    def receive(self, api: FakeBotApi, method: str, message: dict):
+        if method == "sendVideo" and "upload:" not in json.dumps(message.get("reply_markup") or {}):
+            self.videos += 1
+            self.video_bytes += message["video"]["file_size"]
+        text = message.get("text") or message.get("caption") or ""
+        if text.startswith("Download folder removed"):
+            self.mark("done")
+            self.done.set()
+            return
+
+        keyboard = [button for row in (message.get("reply_markup") or {}).get("inline_keyboard", []) for button in row]
+        buttons = [button["callback_data"] for button in keyboard]
+        if "audio:" not in self.pressed and any(data.startswith("audio:") for data in buttons):
+            # Tick the wanted tracks one press at a time, every press edits the keyboard
+            self.mark("downloaded")
+            tracks = [button for button in keyboard if button["callback_data"].split(":")[1].isdigit()]
+            wanted = tracks[:1] if self.audio == "first" else tracks
+            unticked = next((button["callback_data"] for button in wanted if button["text"].startswith("[ ]")), None)
+            data = unticked or next(data for data in buttons if data.startswith(AUDIO_CONTINUE[self.audio] + ":"))
+            if not unticked:
+                self.pressed.add("audio:")
+            threading.Timer(self.think, api.press, (self, message, data)).start()
+            return
+        for wanted in FLOW_BUTTONS:
+            data = next((data for data in buttons if data.startswith(wanted)), None)
+            if data and wanted not in self.pressed:
+                self.pressed.add(wanted)
+                self.mark({"accept:yes": "preview", "sample:yes": "downloaded",
+                           "upload:yes": "sampled", "remove:yes": "uploaded"}[wanted])
+                self.mark(f"pressed {wanted}")
+                threading.Timer(self.think, api.press, (self, message, data)).start()
+                return
+
+    def stages(self) -> dict:
+        events = self.events
+        spans = {
+            "preview": ("start", "preview"),
+            "download": ("pressed accept:yes", "downloaded"),
+            "sample": ("pressed sample:yes", "sampled"),
+            "upload": ("pressed upload:yes", "uploaded"),
+            "total": ("start", "done"),
+        }
+        return {stage: events[end] - events[start] for stage, (start, end) in spans.items() if start in events and end in events}
+
+
+class DiskSampler(threading.Thread):
+    def __init__(self, path: str, interval=0.5):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.peak = max(self.peak, folder_size(self.path))
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def peak_memory(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values: list[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def report(users: list[User], wall: float, cpu: dict, disk: dict, requests: dict) -> dict:
+    result = {"users": len(users), "completed": sum(user.done.is_set() for user in users), "wall": wall, "stages": {}}
+    for stage in STAGES:
+        values = [user.stages()[stage] for user in users if stage in user.stages()]
+        if values:
+            result["stages"][stage] = {
+                "count": len(values),
+                "min": min(values),
+                "median": statistics.median(values),
+                "p95": percentile(values, 95),
+                "max": max(values),
+            }
+    result["videos"] = sum(user.videos for user in users)
+    result["video_bytes"] = sum(user.video_bytes for user in users)
+    result["cpu"] = cpu
+    result["disk"] = disk
+    result["requests"] = requests
+    return result
+
+
+def print_report(result: dict):
+    print(f"\nUsers: {result['completed']}/{result['users']} completed in {result['wall']:.1f} s")
+    print(f"Videos received: {result['videos']} ({result['video_bytes'] / (1 << 20):.1f} MB)")
+    print(f"\n{'stage':<10}{'count':>7}{'min':>9}{'median':>9}{'p95':>9}{'max':>9}")
+    for stage, values in result["stages"].items():
+        print(f"{stage:<10}{values['count']:>7}" + "".join(f"{values[key]:>9.2f}" for key in ("min", "median", "p95", "max")))
+    cpu = result["cpu"]
+    print(f"\nCPU: {cpu['user']:.1f} s user, {cpu['system']:.1f} s system ({cpu['utilization']:.0%} of one core), bot peak RSS {cpu['peak_rss'] / (1 << 20):.0f} MB")
+    disk = result["disk"]
+    print(f"Disk: peak {disk['peak'] / (1 << 20):.1f} MB in CONFIG_FOLDER, {disk['read'] / (1 << 20):.1f} MB read, {disk['written'] / (1 << 20):.1f} MB written")
+    print("Bot API calls: " + ", ".join(f"{method} {count}" for method, count in sorted(result["requests"].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the bot through the full flow with simulated users.")
+    parser.add_argument("--users", type=int, default=4, help="number of concurrent users")
+    parser.add_argument("--videos", type=int, default=3, help="videos per torrent")
+    parser.add_argument("--duration", type=int, default=30, help="seconds per video")
+    parser.add_argument("--size", default="1280x720", help="video frame size")
+    parser.add_argument("--codecs", default="h264,mpeg4", help="comma-separated video codecs, h264 is remuxed and the others transcoded")
+    parser.add_argument("--container", choices=("mkv", "mp4"), default="mkv",
+                        help="fixture container, faststart MP4 files with h264 are sent without a conversion")
+    parser.add_argument("--audio-tracks", type=int, default=2, help="audio tracks per video")
+    parser.add_argument("--audio", choices=tuple(AUDIO_CONTINUE), default="first",
+                        help="upload the first audio track, all tracks in one video, or one video per track")
+    parser.add_argument("--think", type=float, default=0.2, help="seconds a user waits before pressing a button")
+    parser.add_argument("--stagger", type=float, default=0.0, help="seconds between users starting")
+    parser.add_argument("--timeout", type=float, default=1800, help="give up after this many seconds")
+    parser.add_argument("--stream", action="store_true", help="stream uploads over HTTP instead of passing local paths")
+    parser.add_argument("--bot", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py"))
+    parser.add_argument("--work", default=os.path.join(tempfile.gettempdir(), "sharetorrent-benchmark"))
+    parser.add_argument("--port", type=int, default=18081, help="port of the fake Bot API, the seeder and the bot use the next two")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra environment for the bot")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    fixtures = make_fixtures(os.path.join(args.work, "fixtures"), args.videos, args.duration, args.size,
+                             args.codecs.split(","), args.audio_tracks, args.container)
+    config = os.path.join(args.work, "config")
+    shutil.rmtree(config, ignore_errors=True)
+    shutil.rmtree(os.path.join(args.work, "users"), ignore_errors=True)
+    os.makedirs(config)
+
+    api = FakeBotApi(args.port, args.port + 1)
+    seeder = Seeder(args.port + 1)
+    users, torrents = [], []
+    for n in range(1, args.users + 1):
+        user = User(1000 + n, args.think, args.audio)
+        torrent = make_user_torrent(os.path.join(args.work, "users", str(n)), f"bench-{n}", fixtures, f"{api.url}/announce")
+        seeder.seed(torrent)
+        api.add_user(user)
+        users.append(user)
+        torrents.append(torrent)
+    api.start()
+
+    env = {
+        **os.environ,
+        "BOT_TOKEN": "123456:benchmark",
+        "BASE_URL": api.url,
+        "CONFIG_FOLDER": config,
+        "LOCAL_MODE": "1",
+        "LOCAL_PATHS": "/nonexistent=/nonexistent" if args.stream else f"{config}={config}",
+        "LISTEN_INTERFACES": f"127.0.0.1:{args.port + 2}",
+        "AVAILABLE_USER_IDS": "",
+        "UPLOAD_CHAT_ID": "",
+        "DISK_RESERVE": "0",
+    }
+    env.update(item.split("=", 1) for item in args.env)
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(os.path.join(args.work, "bot.log"), "w") as log:
+        bot = subprocess.Popen([sys.executable, args.bot], cwd=os.path.dirname(args.bot), env=env, stdout=log, stderr=subprocess.STDOUT)
+    sampler = DiskSampler(config)
+    sampler.start()
+
+    start = time.monotonic()
+    time.sleep(2)
+    for user, torrent in zip(users, torrents):
+        user.mark("start")
+        api.send_document(user, torrent)
+        time.sleep(args.stagger)
+    for user in users:
+        user.done.wait(max(0.0, args.timeout - (time.monotonic() - start)))
+    wall = time.monotonic() - min(user.events["start"] for user in users)
+
+    rss = peak_memory(bot.pid)
+    bot.send_signal(signal.SIGINT)
+    try:
+        bot.wait(60)
+    except subprocess.TimeoutExpired:
+        bot.kill()
+        bot.wait()
+    sampler.stop()
+    api.stop()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    user_time = after.ru_utime - before.ru_utime
+    system_time = after.ru_stime - before.ru_stime
+    cpu = {"user": user_time, "system": system_time, "utilization": (user_time + system_time) / wall, "peak_rss": rss}
+    disk = {"peak": sampler.peak, "read": (after.ru_inblock - before.ru_inblock) * 512, "written": (after.ru_oublock - before.ru_oublock) * 512}
+    result = report(users, wall, cpu, disk, api.requests)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    sys.exit(0 if result["completed"] == result["users"] else 1)
+
+
+if __name__ == "__main__":
+    main()
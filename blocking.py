@@ -0,0 +1,36 @@
+import os, asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+CLEANUP_NICE = 19
+
+
+class BlockingExecutor:
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max(1, max_workers), thread_name_prefix="blocking")
+        # Deletions run one at a time on their own low priority thread, behind everything else
+        self._cleanup = ThreadPoolExecutor(1, thread_name_prefix="cleanup", initializer=lower_thread_priority, initargs=(CLEANUP_NICE,))
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def cleanup(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._cleanup, partial(func, *args, **kwargs))
+
+
+def lower_thread_priority(nice: int):
+    # On Linux the nice value is per thread, and it also lowers the disk priority of the thread's I/O
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+    except (OSError, AttributeError):
+        pass
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_bytes(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
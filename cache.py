@@ -0,0 +1,55 @@
+import os, time, shutil
+
+
+def folder_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def evict_downloads(download_root: str, quota: int = None, keep=(), free=0) -> list[str]:
+    if not os.path.isdir(download_root):
+        return []
+    keep = {os.path.realpath(path) for path in keep}
+    entries = []
+    for name in os.listdir(download_root):
+        path = os.path.join(download_root, name)
+        if os.path.isdir(path):
+            entries.append((os.path.getmtime(path), path, folder_size(path)))
+    total = sum(entry[2] for entry in entries)
+    target = min(total if quota is None else quota, total - free)
+
+    evicted = []
+    for _, path, size in sorted(entries):
+        if total <= target:
+            break
+        if os.path.realpath(path) in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted.append(path)
+    return evicted
+
+
+def evict_stale(folders: list[str], max_age: float, keep=()) -> list[str]:
+    keep = {os.path.realpath(path) for path in keep}
+    deadline = time.time() - max_age
+    evicted = []
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.realpath(path) in keep or os.path.getmtime(path) > deadline:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+            evicted.append(path)
+    return evicted
@@ -0,0 +1,91 @@
+import asyncio, shutil, ffmpeg
+from contextlib import nullcontext
+from scheduler import Scheduler, INTERACTIVE, BULK
+
+REMUX = "remux"
+TRANSCODE = "transcode"
+IONICE_CLASSES = {"best-effort": ("-c", "2", "-n", "7"), "idle": ("-c", "3")}
+
+
+class ConversionPool:
+    def __init__(self, remux_workers: int, transcode_workers: int, interactive_workers=1, bulk_nice=0, bulk_ionice=""):
+        self._slots = {
+            REMUX: Scheduler(remux_workers, interactive_workers),
+            TRANSCODE: Scheduler(transcode_workers, interactive_workers),
+        }
+        self.bulk_prefix = low_priority_prefix(bulk_nice, bulk_ionice)
+
+    @property
+    def waiting(self) -> dict:
+        return {kind: slots.waiting() for kind, slots in self._slots.items()}
+
+    @property
+    def running(self) -> dict:
+        return {kind: slots.running for kind, slots in self._slots.items()}
+
+    async def run(self, pipelines: list, transcode: bool, on_progress=None, parallel=1, priority=BULK, user=None):
+        kind = TRANSCODE if transcode else REMUX
+        prefix = () if priority == INTERACTIVE else self.bulk_prefix
+        slot = lambda: self._slots[kind].slot(priority, user)
+        for index, pipeline in enumerate(pipelines):
+            report = lambda progress: on_progress(index, progress) if on_progress else None
+            if isinstance(pipeline, list):
+                # A nested list is one step of independent pipelines, like the segments of a chunked encode.
+                # Each takes a slot of its own, so a chunked encode never runs more encoders than the pool allows.
+                await run_parallel(pipeline, parallel, report, prefix, slot)
+            else:
+                async with slot():
+                    await run_ffmpeg(pipeline, report, prefix)
+
+
+def low_priority_prefix(nice: int, ionice: str) -> tuple:
+    prefix = ()
+    if nice and shutil.which("nice"):
+        prefix += ("nice", "-n", str(nice))
+    if IONICE_CLASSES.get(ionice) and shutil.which("ionice"):
+        prefix += ("ionice", *IONICE_CLASSES[ionice])
+    return prefix
+
+
+async def run_ffmpeg(pipeline, on_progress=None, prefix=()):
+    args = pipeline.compile()
+    process = await asyncio.create_subprocess_exec(
+        *prefix, args[0], "-nostats", "-progress", "pipe:1", *args[1:],
+        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, err = await asyncio.gather(read_progress(process.stdout, on_progress), process.stderr.read())
+        await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", None, err)
+
+
+async def run_parallel(pipelines: list, workers: int, on_progress=None, prefix=(), slot=None):
+    slots = asyncio.Semaphore(max(1, workers))
+
+    async def _run(number, pipeline):
+        async with slots, (slot() if slot else nullcontext()):
+            await run_ffmpeg(pipeline, lambda progress: on_progress({**progress, "segment": number}) if on_progress else None, prefix)
+
+    tasks = [asyncio.create_task(_run(number, pipeline)) for number, pipeline in enumerate(pipelines)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def read_progress(stream, on_progress):
+    progress = {}
+    async for line in stream:
+        key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+        progress[key] = value
+        if key == "progress":
+            if on_progress:
+                on_progress(progress)
+            progress = {}
@@ -0,0 +1,45 @@
+import shutil
+
+
+class DiskAdmission:
+    def __init__(self, path: str, reserve: int):
+        self.path = path
+        self.reserve = reserve
+        self._requests = {}
+        self._reserved = {}
+
+    def available(self) -> int:
+        reserved = sum(download + convert for download, convert in self._reserved.values())
+        return shutil.disk_usage(self.path).free - self.reserve - reserved
+
+    def request(self, job_id, download: int, convert: int):
+        self._requests[job_id] = (max(0, download), max(0, convert))
+
+    def need(self, job_id) -> int:
+        return sum(self._requests.get(job_id) or self._reserved.get(job_id) or (0, 0))
+
+    def fits(self, job_id) -> bool:
+        return job_id in self._reserved or self.need(job_id) <= self.available()
+
+    def admit(self, job) -> bool:
+        if job.id not in self._requests:
+            return True
+        if not self.fits(job.id):
+            return False
+        self._reserved[job.id] = self._requests.pop(job.id)
+        return True
+
+    def downloaded(self, job_id, remaining: int):
+        if job_id in self._reserved:
+            self._reserved[job_id] = (max(0, remaining), self._reserved[job_id][1])
+
+    def release(self, job_id):
+        self._requests.pop(job_id, None)
+        self._reserved.pop(job_id, None)
+
+    def busy(self) -> bool:
+        return bool(self._reserved)
+
+
+def conversion_estimate(sizes: list[int], ahead: int, size_limit: int) -> int:
+    return sum(sorted((min(size, size_limit) for size in sizes), reverse=True)[:max(1, ahead)])
@@ -0,0 +1,118 @@
+COPY_VIDEO_CODECS = ("h264",)
+COPY_PIXEL_FORMATS = ("yuv420p", "yuvj420p")
+COPY_PROFILES = ("Constrained Baseline", "Baseline", "Main", "High")
+COPY_AUDIO_CODECS = ("aac", "mp3")
+SCALE_HEIGHTS = (2160, 1440, 1080, 720, 576, 480, 360)
+AUDIO_BITRATE = 256_000
+CONTAINER_OVERHEAD = 0.97
+MIN_BITS_PER_PIXEL = 0.05
+MIN_VIDEO_BITRATE = 200_000
+MAX_VIDEO_BITRATE = 100_000_000
+SPLIT_MARGIN = 0.9
+
+
+def video_stream(probe: dict) -> dict:
+    for stream in probe.get("streams") or []:
+        if stream.get("codec_type") == "video" and not (stream.get("disposition") or {}).get("attached_pic"):
+            return stream
+    return {}
+
+
+def audio_streams(probe: dict) -> list[dict]:
+    return [stream for stream in probe.get("streams") or [] if stream.get("codec_type") == "audio"]
+
+
+def can_copy_audio(stream: dict) -> bool:
+    return stream.get("codec_name") in COPY_AUDIO_CODECS
+
+
+def can_copy_video(stream: dict) -> bool:
+    return (
+        stream.get("codec_name") in COPY_VIDEO_CODECS
+        and stream.get("pix_fmt") in COPY_PIXEL_FORMATS
+        and stream.get("profile") in COPY_PROFILES
+    )
+
+
+def can_send_as_is(probe: dict, audio) -> bool:
+    # An MP4 holding only streams the remux would copy, all of them selected
+    fmt = probe.get("format") or {}
+    brand = ((fmt.get("tags") or {}).get("major_brand") or "").strip()
+    if "mp4" not in (fmt.get("format_name") or "").split(",") or brand == "qt":
+        return False
+    streams = probe.get("streams") or []
+    videos = [stream for stream in streams if stream.get("codec_type") == "video"]
+    audios = audio_streams(probe)
+    if len(videos) != 1 or not can_copy_video(videos[0]) or len(videos) + len(audios) != len(streams):
+        return False
+    selected = [audio] if isinstance(audio, int) else audio if isinstance(audio, list) else range(len(audios))
+    return sorted(selected) == list(range(len(audios))) and all(can_copy_audio(stream) for stream in audios)
+
+
+def frame_rate(stream: dict) -> float:
+    try:
+        num, den = (stream.get("avg_frame_rate") or stream.get("r_frame_rate") or "").split("/")
+        return int(num) / int(den)
+    except:
+        return 25.0
+
+
+def encode_plan(probe: dict, size_limit: int, crf=23, two_pass=False, audio_tracks=1) -> dict:
+    fmt = probe.get("format") or {}
+    size = int(fmt.get("size") or 0)
+    duration = float(fmt.get("duration") or 0.0)
+    stream = video_stream(probe)
+    width = int(stream.get("width") or 0)
+    height = int(stream.get("height") or 0)
+    fits = size <= size_limit
+
+    plan = {"vcodec": "copy", "height": None, "crf": None, "bitrate": None, "maxrate": None, "two_pass": False}
+    if fits and can_copy_video(stream):
+        return plan
+
+    plan["vcodec"] = "libx264"
+    if duration <= 0 or not width or not height:
+        plan["crf"] = crf
+        if not fits:
+            plan["height"] = height // 2 if height else None
+        return plan
+
+    budget = min(MAX_VIDEO_BITRATE, max(MIN_VIDEO_BITRATE, int(size_limit * 8 * CONTAINER_OVERHEAD / duration) - AUDIO_BITRATE * max(1, audio_tracks)))
+    if fits:
+        plan["crf"] = crf
+        plan["maxrate"] = budget
+    else:
+        plan["bitrate"] = budget
+        plan["two_pass"] = two_pass
+        if not two_pass:
+            plan["maxrate"] = budget
+
+    fps = frame_rate(stream)
+    for scaled in SCALE_HEIGHTS:
+        if scaled >= height:
+            continue
+        if budget / (width * height * fps) >= MIN_BITS_PER_PIXEL:
+            break
+        width, height = width * scaled // height, scaled
+        plan["height"] = scaled
+    return plan
+
+
+def video_args(plan: dict, preset: str) -> dict:
+    args = {"vcodec": plan["vcodec"]}
+    if plan["vcodec"] == "copy":
+        return args
+    args["preset"] = preset
+    args["pix_fmt"] = "yuv420p"
+    if plan["crf"] is not None:
+        args["crf"] = plan["crf"]
+    if plan["bitrate"]:
+        args["video_bitrate"] = plan["bitrate"]
+    if plan["maxrate"]:
+        args["maxrate"] = plan["maxrate"]
+        args["bufsize"] = plan["maxrate"] * 2
+    return args
+
+
+def segment_time(duration: float, size: int, size_limit: int) -> float:
+    return duration * size_limit * SPLIT_MARGIN / size
@@ -0,0 +1,122 @@
+import asyncio, heapq, itertools, uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Job:
+    def __init__(self, user_id, chat_id, name, priority=0, job_id=None):
+        self.id = job_id or uuid.uuid4().hex[:8]
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.name = name
+        self.priority = priority
+        self.state = QUEUED
+        self.cancelled = asyncio.Event()
+        self.task: asyncio.Task = None
+        self.handle = None
+        self.ready_files = set()
+        self._changed = asyncio.Event()
+
+    @property
+    def active(self):
+        return self.state in (QUEUED, RUNNING)
+
+    def file_ready(self, index):
+        self.ready_files.add(index)
+        self._changed.set()
+
+    async def wait_file(self, index) -> bool:
+        while index not in self.ready_files:
+            if not self.active or self.cancelled.is_set():
+                return False
+            self._changed.clear()
+            await self._changed.wait()
+        return True
+
+    def __repr__(self):
+        return f"Job({self.id}, {self.name}, {self.state})"
+
+
+class JobManager:
+    def __init__(self, max_running: int, admit=None, refuse=None):
+        self.max_running = max(1, max_running)
+        self.admit = admit
+        self.refuse = refuse
+        self.jobs: dict[str, Job] = {}
+        self._waiting = []
+        self._order = itertools.count()
+        self._running = 0
+
+    def submit(self, job: Job, run, refused=None) -> Job:
+        self.jobs[job.id] = job
+        heapq.heappush(self._waiting, (job.priority, next(self._order), job, run, refused))
+        self.dispatch()
+        return job
+
+    def position(self, job: Job):
+        if job.state != QUEUED:
+            return 0
+        waiting = sorted((priority, order) for priority, order, j, _, _ in self._waiting if j.state == QUEUED)
+        mine = next((priority, order) for priority, order, j, _, _ in self._waiting if j is job)
+        return waiting.index(mine) + 1
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if not job or job.cancelled.is_set():
+            return False
+        job.cancelled.set()
+        job._changed.set()
+        if job.state == QUEUED:
+            job.state = CANCELLED
+        elif job.task and not job.task.done():
+            job.task.cancel()
+        return True
+
+    def user_jobs(self, user_id):
+        return [job for job in self.jobs.values() if job.user_id == user_id]
+
+    def forget(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job and job.state == RUNNING and job.task:
+            # A cancelled download is dropped once its task has ended and its state is settled
+            job.task.add_done_callback(lambda _: self.jobs.pop(job_id, None))
+        elif job and not job.active:
+            del self.jobs[job_id]
+
+    def dispatch(self):
+        while self._running < self.max_running and self._waiting:
+            job = self._waiting[0][2]
+            if job.state == QUEUED and self.admit and not self.admit(job):
+                if not self.refuse or not self.refuse(job):
+                    break
+                # It can never be admitted, so drop it instead of holding up the jobs behind it
+                _, _, job, _, refused = heapq.heappop(self._waiting)
+                job.state = FAILED
+                job._changed.set()
+                if refused:
+                    refused(job)
+                continue
+            _, _, job, run, _ = heapq.heappop(self._waiting)
+            if job.state != QUEUED:
+                continue
+            self._running += 1
+            job.state = RUNNING
+            job.task = asyncio.create_task(run(job))
+            # A done callback rather than a finally, which a task cancelled before its first step never runs
+            job.task.add_done_callback(lambda task, job=job: self._finished(job, task))
+
+    def _finished(self, job: Job, task: asyncio.Task):
+        if task.cancelled():
+            job.state = CANCELLED
+        elif task.exception():
+            print(f"Job {job.id} failed: {task.exception()}")
+            job.state = FAILED
+        else:
+            job.state = CANCELLED if job.cancelled.is_set() else DONE
+        job._changed.set()
+        self._running -= 1
+        self.dispatch()
@@ -1,11 +1,26 @@
-import os, dotenv, shutil, asyncio, ffmpeg
+import os, time, dotenv, glob, shutil, asyncio, ffmpeg, httpx
+from urllib.parse import urlparse
 from warnings import filterwarnings
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, Bot
-from telegram.ext import filters, Application, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler
+from telegram.ext import filters, Application, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler, PicklePersistence
 from telegram.warnings import PTBUserWarning
-from telegram.error import InvalidToken
+from telegram.error import InvalidToken, BadRequest
 import libtorrent as lt
-from torrentp import TorrentDownloader
+from jobs import Job, JobManager, QUEUED, RUNNING, DONE as JOB_DONE
+from torrents import TorrentSession, torrent_bytes
+from convert import ConversionPool, run_ffmpeg, REMUX, TRANSCODE
+from scheduler import INTERACTIVE
+from probe import ProbeCache
+from blocking import BlockingExecutor, read_bytes, write_bytes
+from encode import encode_plan, video_args, video_stream, can_copy_video, can_send_as_is, audio_streams, can_copy_audio, segment_time
+from store import JobStore, UploadCache, DOWNLOAD, READY, UPLOAD, DONE
+from cache import evict_downloads, evict_stale, folder_size
+from disk import DiskAdmission, conversion_estimate
+from progress import ProgressReporter
+from upload import Uploader, parse_path_map, server_uri
+from stage import is_faststart, link_file
+from preview import SummaryCache, summarize, selected_videos
+from metrics import Metrics, event, SPEED_BUCKETS, FPS_BUCKETS
 
 dotenv.load_dotenv()
 filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
@@ -16,26 +31,142 @@ timeout = os.getenv("READ_TIMEOUT") or 30
 upload_chat_id = os.getenv("UPLOAD_CHAT_ID")
 available_user_ids = os.getenv("AVAILABLE_USER_IDS")
 config_folder = os.getenv('CONFIG_FOLDER') or '/'
+max_downloads = os.getenv("MAX_DOWNLOADS") or 2
+listen_interfaces = os.getenv("LISTEN_INTERFACES") or "0.0.0.0:6881,[::]:6881"
+connections_limit = os.getenv("CONNECTIONS_LIMIT") or 400
+cache_size = os.getenv("CACHE_SIZE") or 4096
+aio_threads = os.getenv("AIO_THREADS") or 8
+download_rate_limit = os.getenv("DOWNLOAD_RATE_LIMIT") or 0
+upload_rate_limit = os.getenv("UPLOAD_RATE_LIMIT") or 0
+remux_workers = os.getenv("REMUX_WORKERS") or os.cpu_count() or 1
+transcode_workers = os.getenv("TRANSCODE_WORKERS") or max(1, (os.cpu_count() or 1) // 4)
+convert_ahead = os.getenv("CONVERT_AHEAD") or 2
+probe_cache_size = os.getenv("PROBE_CACHE_SIZE") or 256
+io_workers = os.getenv("IO_WORKERS") or 4
+upload_size_limit = os.getenv("UPLOAD_SIZE_LIMIT") or 2000
+encode_crf = os.getenv("ENCODE_CRF") or 23
+encode_preset = os.getenv("ENCODE_PRESET") or "medium"
+encode_two_pass = (os.getenv("ENCODE_TWO_PASS") or "").lower() in ("1", "true", "yes")
+segment_min_duration = os.getenv("SEGMENT_MIN_DURATION") or 1200
+segment_workers = os.getenv("SEGMENT_WORKERS") or transcode_workers
+sample_length = os.getenv("SAMPLE_LENGTH") or 120
+sample_height = os.getenv("SAMPLE_HEIGHT") or 480
+resume_data_interval = os.getenv("RESUME_DATA_INTERVAL") or 60
+progress_interval = os.getenv("PROGRESS_INTERVAL") or 3
+upload_parallel = os.getenv("UPLOAD_PARALLEL") or 1
+upload_retries = os.getenv("UPLOAD_RETRIES") or 3
+upload_backoff = os.getenv("UPLOAD_BACKOFF") or 2
+local_mode = (os.getenv("LOCAL_MODE") or "auto").lower()
+local_paths = os.getenv("LOCAL_PATHS") or f"{config_folder}/home=/home"
+download_cache_quota = os.getenv("DOWNLOAD_CACHE_QUOTA") or 0
+upload_cache_size = os.getenv("UPLOAD_CACHE_SIZE") or 10000
+disk_reserve = os.getenv("DISK_RESERVE") or 1024
+stale_age = os.getenv("STALE_AGE") or 24
+metadata_timeout = os.getenv("METADATA_TIMEOUT") or 60
+prefetch_timeout = os.getenv("PREFETCH_TIMEOUT") or 600
+metrics_host = os.getenv("METRICS_HOST") or "127.0.0.1"
+metrics_port = os.getenv("METRICS_PORT") or 0
+preview_page_size = os.getenv("PREVIEW_PAGE_SIZE") or 10
+interactive_workers = os.getenv("INTERACTIVE_WORKERS") or 1
+bulk_nice = os.getenv("BULK_NICE") or 10
+bulk_ionice = os.getenv("BULK_IONICE") or "best-effort"
 
 torrent = "torrent"
 video_exts = (".mp4", ".mkv", ".mov", ".avi", ".webm", ".m4v")
+# Number of largest files listed in a torrent preview
+PREVIEW_LARGEST = 5
+PREVIEW_CACHE_SIZE = 32
+max_torrent_size = 10 << 20
+# Chunked encodes cut twice as many segments as there are workers, so a slow segment does not hold up the rest
+SEGMENTS_PER_WORKER = 2
+MIN_SEGMENT_SECONDS = 30
 
 FLOW = range(1)
-
-downloader: TorrentDownloader = None
-download_cancelled = False
+AUDIO_TRACKS = "tracks"
+AUDIO_FILES = "files"
+
+downloading_text = "Accepted. Downloading torrent file...\nType /cancel to stop downloading."
+expired_text = "This download has moved on, finished or been cancelled."
+
+disk = DiskAdmission(config_folder, int(disk_reserve) << 20)
+jobs = JobManager(int(max_downloads), disk.admit, lambda job: refuse_job(job))
+rooms_made = set()
+torrents = TorrentSession({
+    "listen_interfaces": listen_interfaces,
+    "connections_limit": int(connections_limit),
+    "cache_size": int(cache_size),
+    "aio_threads": int(aio_threads),
+    "download_rate_limit": int(download_rate_limit),
+    "upload_rate_limit": int(upload_rate_limit),
+    "active_downloads": -1,
+    "active_seeds": -1,
+})
+conversions = ConversionPool(int(remux_workers), int(transcode_workers), int(interactive_workers), int(bulk_nice), bulk_ionice)
+probes = ProbeCache(int(probe_cache_size))
+summaries = SummaryCache(PREVIEW_CACHE_SIZE)
+blocking = BlockingExecutor(int(io_workers))
+progress = ProgressReporter(float(progress_interval))
+uploader = Uploader(int(upload_parallel), int(upload_retries), float(upload_backoff))
+local_api = local_mode in ("1", "true", "yes") or (local_mode == "auto" and urlparse(base_url).hostname != "api.telegram.org")
+server_paths = parse_path_map(local_paths) if local_api else []
+store: JobStore = None
+upload_cache: UploadCache = None
+download_rates = {}
+background = set()
+
+metrics = Metrics("sharetorrent")
+metrics.counter("torrents_received_total", "Torrents received, by source")
+metrics.histogram("torrent_parse_seconds", "Time to parse a .torrent file")
+metrics.histogram("metadata_fetch_seconds", "Time to fetch the metadata of a magnet link, by result")
+metrics.histogram("download_seconds", "Time from the start of a download until all selected files are complete")
+metrics.counter("downloaded_bytes_total", "Bytes of selected files downloaded")
+metrics.gauge("download_rate_bytes", "Current download rate of all running downloads in bytes per second", lambda: sum(list(download_rates.values())))
+metrics.counter("probes_total", "ffprobe lookups, by cache result",
+                lambda: [({"cache": "hit"}, probes.hits), ({"cache": "miss"}, probes.misses)])
+metrics.counter("probe_seconds_total", "Time spent running ffprobe", lambda: probes.seconds)
+metrics.counter("conversions_total", "Finished conversions, by mode (remux, transcode, or hardlink and reflink for inputs staged as they are)")
+metrics.histogram("convert_seconds", "Wall-clock time of a conversion including its wait for a converter, by mode")
+metrics.histogram("convert_speed", "Seconds of video converted per second of conversion, by mode", SPEED_BUCKETS)
+metrics.histogram("encode_fps", "Average frames per second of finished transcodes", FPS_BUCKETS)
+metrics.counter("uploads_total", "Uploaded videos and parts, by mode")
+metrics.counter("upload_bytes_total", "Bytes uploaded, by mode")
+metrics.histogram("upload_seconds", "Time to send one video or part, by mode")
+metrics.counter("upload_retries_total", "Retried Bot API calls, by reason",
+                lambda: [({"reason": reason}, count) for reason, count in uploader.retried.items()])
+metrics.gauge("jobs", "Jobs by state", lambda: [({"state": state}, sum(job.state == state for job in list(jobs.jobs.values()))) for state in (QUEUED, RUNNING)])
+metrics.gauge("conversions_waiting", "Conversions waiting for a converter, by mode and priority class",
+              lambda: [({"mode": mode, "priority": priority}, count) for mode, counts in conversions.waiting.items() for priority, count in counts.items()])
+metrics.gauge("conversions_running", "Running conversions, by mode", lambda: [({"mode": mode}, count) for mode, count in conversions.running.items()])
+metrics.gauge("disk_available_bytes", "Free space in CONFIG_FOLDER minus the reserve and the space reserved by running jobs", disk.available)
 
 async def start(update, _):
     message = update.message
     username = message.from_user["username"]
     await message.reply_text(f"Hey, @{username}.\n"
                              "Welcome to Share Torrent bot\n"
-                             "Upload a valid .torrent file to start download\n\n"
+                             "Upload a valid .torrent file or send a magnet link to start download\n\n"
                              "/help - for more details")
 
 
 async def help(update, _) -> None:
-    await update.message.reply_markdown("Upload a valid .torrent file to start download")
+    await update.message.reply_markdown("Upload a valid .torrent file or send a magnet link to start download\n\n"
+                                        "/jobs - show your downloads\n"
+                                        "/cancel - stop your download\n"
+                                        "/cancel <id> - stop one of several downloads")
+
+
+async def list_jobs(update, _) -> None:
+    user_jobs = jobs.user_jobs(update.effective_user.id)
+    if not user_jobs:
+        await update.message.reply_text("You have no downloads.")
+        return
+    lines = []
+    for job in user_jobs:
+        position = jobs.position(job)
+        queued = f", position {position} in queue" if position else ""
+        lines.append(f"- [{job.id}] {job.name}: {job.state}{queued}")
+    lines.append("Type /cancel <id> to stop one of them.")
+    await update.message.reply_text("\n".join(lines))
 
 
 async def unknown(update, _):
@@ -43,22 +174,39 @@ async def unknown(update, _):
 
 
 async def cancel(update, context) -> int:
-    global downloader, download_cancelled
-    download_cancelled = True
-    if downloader:
-        downloader.stop_download()
-        downloader = None
-        return await ask_remove_downloads(update, context)
-
-    await update.message.reply_text("Cancelled.", reply_markup=ReplyKeyboardRemove())
+    user_jobs = [job for job in jobs.user_jobs(update.effective_user.id) if not job.cancelled.is_set()]
+    if context.args:
+        user_jobs = [job for job in user_jobs if job.id == context.args[0]]
+        if not user_jobs:
+            await update.message.reply_text(f"No download with id {context.args[0]}. Type /jobs to list your downloads.")
+            return ConversationHandler.END
+    if len(user_jobs) > 1:
+        lines = [f"- [{job.id}] {job.name}" for job in user_jobs]
+        await update.message.reply_text("You have several downloads, type /cancel <id> to stop one of them:\n" + "\n".join(lines))
+        return ConversationHandler.END
+
+    job = user_jobs[0] if user_jobs else None
+    active = job and job.active
+    if job:
+        # Cancel before releasing the disk, which would otherwise let a job queued for space start first
+        jobs.cancel(job.id)
+        finish_job(job.id)
+    if active:
+        await ask_remove_downloads(context.bot, update.message.chat_id, job.id)
+    else:
+        await update.message.reply_text("Cancelled.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
-async def select_torrent(update, context) -> int:
+async def authorized(update) -> bool:
     user_id = update.effective_user.id
-
     if available_user_ids and str(user_id) not in available_user_ids.split(","):
         await update.message.reply_text("You are not authorized to use this bot")
+        return False
+    return True
+
+async def select_torrent(update, context) -> int:
+    if not await authorized(update):
         return ConversationHandler.END
 
     message = update.message
@@ -71,13 +219,13 @@ async def select_torrent(update, context) -> int:
     torrent_dir = f"{config_folder}/torrent"
 
     os.makedirs(torrent_dir, exist_ok=True)
-    torrent_path = os.path.join(torrent_dir, file_name)
+    torrent_path = os.path.join(torrent_dir, f"{document.file_unique_id}.torrent")
     file = await context.bot.get_file(document.file_id)
 
     try:
         file_path = await file.download_to_drive(torrent_path)
         file_path = file_path.as_posix()
-        print(f"download_to_drive: {file_path}")
+        event("torrent_received", source="document", path=file_path, user=update.effective_user.id)
     except InvalidToken:
         file_path = f"{config_folder}/home/" + file.file_path.split("//home/")[-1]
         torrent_path = file_path
@@ -85,295 +233,568 @@ async def select_torrent(update, context) -> int:
         await message.reply_text(f"Failed to download torrent file: {e}")
         return ConversationHandler.END
 
-    file_name = document.file_name
-    download_dir = f"{config_folder}/download/{file_name}"
+    metrics.inc("torrents_received_total", source="document")
+    try:
+        ti = await read_torrent(torrent_path)
+    except Exception as e:
+        await message.reply_text(f"Failed to read torrent file: {e}")
+        return ConversationHandler.END
+
+    return await preview_torrent(message, context, ti, torrent_path, document.file_name)
+
+async def select_link(update, context) -> int:
+    if not await authorized(update):
+        return ConversationHandler.END
+
+    message = update.message
+    link = (message.text or "").strip()
+    torrent_dir = f"{config_folder}/torrent"
+    os.makedirs(torrent_dir, exist_ok=True)
+
+    if link.startswith("magnet:"):
+        metrics.inc("torrents_received_total", source="magnet")
+        status = await message.reply_text("Fetching torrent metadata from peers...")
+        start = time.monotonic()
+        try:
+            infohash = str(lt.parse_magnet_uri(link).info_hashes.get_best())
+            handle = await torrents.fetch_metadata(link, f"{config_folder}/download/{infohash}", float(metadata_timeout))
+        except TimeoutError:
+            metrics.observe("metadata_fetch_seconds", time.monotonic() - start, result="timeout")
+            await status.edit_text("Timed out fetching torrent metadata. Please try again later or send a .torrent file.")
+            return ConversationHandler.END
+        except Exception as e:
+            metrics.observe("metadata_fetch_seconds", time.monotonic() - start, result="error")
+            await status.edit_text(f"Failed to read magnet link: {e}")
+            return ConversationHandler.END
+        metrics.observe("metadata_fetch_seconds", time.monotonic() - start, result="ok")
+        event("torrent_received", source="magnet", infohash=infohash, user=update.effective_user.id, seconds=round(time.monotonic() - start, 3))
+        await status.delete()
+        ti = handle.torrent_file()
+        torrent_path = os.path.join(torrent_dir, f"{infohash}.torrent")
+        await blocking.run(write_bytes, torrent_path, torrent_bytes(handle))
+        return await preview_torrent(message, context, ti, torrent_path, ti.name(), handle)
+
+    metrics.inc("torrents_received_total", source="url")
+    try:
+        content = bytearray()
+        async with httpx.AsyncClient(follow_redirects=True, timeout=float(timeout)) as client:
+            async with client.stream("GET", link) as response:
+                response.raise_for_status()
+                # Stop as soon as the cap is passed, so an oversized body is never read in full
+                async for chunk in response.aiter_bytes():
+                    content += chunk
+                    if len(content) > max_torrent_size:
+                        raise ValueError("file is too large")
+        content = bytes(content)
+        ti = await read_torrent(lt.bdecode(content))
+    except Exception as e:
+        await message.reply_text(f"Failed to download torrent file: {e}")
+        return ConversationHandler.END
+    event("torrent_received", source="url", url=link, user=update.effective_user.id)
+
+    torrent_path = os.path.join(torrent_dir, f"{message.message_id}-{message.chat_id}.torrent")
+    await blocking.run(write_bytes, torrent_path, content)
+    file_name = os.path.basename(urlparse(link).path) or f"{ti.name()}.torrent"
+    return await preview_torrent(message, context, ti, torrent_path, file_name)
+
+async def read_torrent(source) -> lt.torrent_info:
+    start = time.monotonic()
+    ti = await blocking.run(lt.torrent_info, source)
+    metrics.observe("torrent_parse_seconds", time.monotonic() - start)
+    return ti
+
+async def preview_torrent(message, context, ti: lt.torrent_info, torrent_path: str, file_name: str, prefetch=None) -> int:
+    torrent_dir = f"{config_folder}/torrent"
+    infohash = str(ti.info_hashes().get_best())
+    file_path = os.path.join(torrent_dir, f"{infohash}.torrent")
+    if os.path.dirname(torrent_path) == torrent_dir:
+        await blocking.run(os.replace, torrent_path, file_path)
+    else:
+        await blocking.run(shutil.copyfile, torrent_path, file_path)
+    torrent_path = file_path
+
+    download_dir = f"{config_folder}/download/{infohash}"
+    summary = summaries.put(infohash, await blocking.run(summarize, ti, video_exts, PREVIEW_LARGEST))
+    videos = summary["videos"]
 
+    # Only small state is kept per conversation, the file list stays in the summary cache
     torrent_data = {
         "file_path": file_path,
-        "path": torrent_path,
         "torrent_name": file_name,
+        "infohash": infohash,
         "download_dir": download_dir,
-        "file_count": None,
-        "total_size": None,
-        "files": [],
+        "page": 0,
+        "select_all": True,
+        "toggled": [],
     }
+    cached = upload_cache.complete(infohash, [index for index, _, _ in videos], upload_settings())
+    if videos and cached:
+        torrent_data["cached"] = [cached[index] for index, _, _ in videos]
+    if prefetch:
+        # Start on the first video while the user is still looking at the preview
+        torrent_data["prefetch"] = True
+        torrents.want(prefetch, [videos[0][0]] if videos else [])
+        # A timer rather than a sleeping task, which would hold up the application's shutdown
+        asyncio.get_running_loop().call_later(float(prefetch_timeout), stop_prefetch, torrent_data, prefetch)
 
-    try:
-        ti = lt.torrent_info(torrent_path)
-        files = ti.files()
-        total_size = 0
-        listed_files = []
-
-        for idx in range(files.num_files()):
-            fpath = files.file_path(idx)
-            fsize = files.file_size(idx)
-            total_size += fsize
-            listed_files.append({"path": fpath, "size": fsize})
-
-        torrent_data["file_count"] = files.num_files()
-        torrent_data["total_size"] = total_size
-        torrent_data["files"] = listed_files
-    except:
-        # Fallback if libtorrent parsing fails
-        torrent_data["file_count"] = "unknown"
-        torrent_data["total_size"] = "unknown"
-        torrent_data["files"] = []
+    context.user_data[torrent] = torrent_data
 
-    size_str = (
-        f"{torrent_data["total_size"] / (1024 ** 3):.2f} GB" if isinstance(torrent_data.get("total_size"), int) else "unknown"
-    )
-    file_count = torrent_data.get("file_count", "unknown")
+    await message.reply_text(preview_text(torrent_data, summary), reply_markup=preview_keyboard(torrent_data, summary))
+    return FLOW
 
-    file_lines = []
-    for f in (torrent_data.get("files") or [])[:10]:
-        file_lines.append(f"- {f["path"]} ({f["size"] / (1024 ** 2):.2f} MB)")
-    more_note = ""
-    if torrent_data.get("files") and len(torrent_data["files"]) > 10:
-        more_note = f"\n… and {len(torrent_data["files"]) - 10} more"
+async def torrent_summary(torrent_data: dict, ti=None) -> dict:
+    summary = summaries.get(torrent_data["infohash"])
+    if summary is None:
+        ti = ti or await read_torrent(torrent_data["file_path"])
+        summary = summaries.put(torrent_data["infohash"], await blocking.run(summarize, ti, video_exts, PREVIEW_LARGEST))
+    return summary
 
+def preview_pages(summary: dict) -> int:
+    return max(1, -(-len(summary["videos"]) // int(preview_page_size)))
+
+def preview_text(torrent_data: dict, summary: dict) -> str:
+    videos = summary["videos"]
     info_text = (
-        f"Torrent: {file_name}\n"
-        f"Total size: {size_str}\n"
-        f"File count: {file_count}\n"
+        f"Torrent: {torrent_data.get("torrent_name")}\n"
+        f"Total size: {summary["total_size"] / (1024 ** 3):.2f} GB\n"
+        f"File count: {summary["file_count"]} ({len(videos)} videos)\n"
     )
-    if file_lines:
-        info_text += "\nFiles:\n" + "\n".join(file_lines) + more_note
-
-    keyboard = InlineKeyboardMarkup(
-        [
-            [
-                InlineKeyboardButton("Yes, proceed", callback_data="accept:yes"),
-                InlineKeyboardButton("No, cancel", callback_data="accept:no"),
-            ]
-        ]
+    if summary["largest"]:
+        info_text += "\nLargest files:\n" + "\n".join(f"- {path} ({size / (1024 ** 2):.2f} MB)" for path, size in summary["largest"])
+
+    selected = selected_videos(summary, torrent_data)
+    selected_size = sum(size for _, _, size in selected)
+    info_text += (
+        f"\n\nSelected: {len(selected)} of {len(videos)} videos ({selected_size / (1024 ** 3):.2f} GB)\n"
+        "Other files are not downloaded."
     )
+    pages = preview_pages(summary)
+    if len(videos) > 1 and pages > 1:
+        info_text += f"\nPage {torrent_data.get("page", 0) + 1} of {pages}"
+    return info_text
+
+def preview_keyboard(torrent_data: dict, summary: dict):
+    videos = summary["videos"]
+    select_all = torrent_data.get("select_all", True)
+    toggled = set(torrent_data.get("toggled") or [])
+    page_size = int(preview_page_size)
+    page = torrent_data.get("page", 0)
+    pages = preview_pages(summary)
+    buttons = []
+    if len(videos) > 1:
+        for index, f, size in videos[page * page_size:(page + 1) * page_size]:
+            mark = "[x]" if select_all != (index in toggled) else "[ ]"
+            buttons.append([InlineKeyboardButton(f"{mark} {f} ({size / (1024 ** 2):.0f} MB)", callback_data=f"file:{index}")])
+        if pages > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton("< Previous", callback_data=f"file:page:{page - 1}"))
+            if page < pages - 1:
+                navigation.append(InlineKeyboardButton("Next >", callback_data=f"file:page:{page + 1}"))
+            buttons.append(navigation)
+        buttons.append([
+            InlineKeyboardButton("Select all", callback_data="file:all"),
+            InlineKeyboardButton("Select none", callback_data="file:none"),
+        ])
+    buttons.append([
+        InlineKeyboardButton("Yes, proceed", callback_data="accept:yes"),
+        InlineKeyboardButton("No, cancel", callback_data="accept:no"),
+    ])
+    if torrent_data.get("cached"):
+        buttons.append([InlineKeyboardButton("Send again from cache", callback_data="cached:yes")])
+    return InlineKeyboardMarkup(buttons)
+
+async def select_files(update, context) -> int:
+    query = update.callback_query
+    await query.answer()
+    parts = (query.data or "").split(":")
+    torrent_data = context.user_data.get(torrent, {})
+    try:
+        summary = await torrent_summary(torrent_data)
+    except Exception as e:
+        await query.edit_message_text(f"Failed to read torrent file: {e}")
+        return ConversationHandler.END
 
-    context.user_data[torrent] = torrent_data
+    choice = parts[-1]
+    if len(parts) > 2 and parts[1] == "page":
+        torrent_data["page"] = min(max(0, int(choice)), preview_pages(summary) - 1)
+    elif choice in ("all", "none"):
+        torrent_data["select_all"] = choice == "all"
+        torrent_data["toggled"] = []
+    else:
+        try:
+            torrent_data["toggled"] = sorted(set(torrent_data.get("toggled") or []) ^ {int(choice)})
+        except ValueError:
+            pass
 
-    await message.reply_text(info_text, reply_markup=keyboard)
+    try: await query.edit_message_text(preview_text(torrent_data, summary), reply_markup=preview_keyboard(torrent_data, summary))
+    except BadRequest: pass
     return FLOW
 
+def stop_prefetch(torrent_data: dict, handle=None):
+    if torrent_data.pop("prefetch", False):
+        torrents.remove(handle or torrents.session.find_torrent(lt.sha1_hash(bytes.fromhex(torrent_data["infohash"]))))
+
 async def accept_torrent(update, context) -> int:
-    global downloader, download_cancelled
     query = update.callback_query
     await query.answer()
     decision = (query.data or "").split(":")[-1]
 
+    torrent_data = context.user_data.get(torrent, {})
     if decision == "no":
+        stop_prefetch(torrent_data)
         await query.edit_message_text("Cancelled.")
         return ConversationHandler.END
 
-    await query.edit_message_text("Accepted. Downloading torrent file...\nType /cancel to stop downloading.")
-
-    torrent_data = context.user_data.get(torrent, {})
     file_path = torrent_data.get("file_path")
     download_dir = torrent_data.get("download_dir")
-    os.makedirs(download_dir, exist_ok=True)
 
-    downloader = TorrentDownloader(file_path, download_dir)
-    download_cancelled = False
+    try:
+        ti = await read_torrent(file_path)
+    except Exception as e:
+        await query.edit_message_text(f"Failed to read torrent file: {e}")
+        return ConversationHandler.END
 
-    chat_id = query.message.chat_id
-    async def _after_download() -> int:
-        nonlocal download_dir
-        global downloader
-        if download_cancelled:
-            await query.message.delete()
-            return ConversationHandler.END
+    summary = await torrent_summary(torrent_data, ti)
+    name, directory, files = torrent_layout(summary, download_dir)
+    if len(files) == 0:
+        await query.edit_message_text("Error: no video files in torrent")
+        return ConversationHandler.END
+    if "selected" in torrent_data:
+        files = [(index, f) for index, f in files if index in torrent_data["selected"]]
+    else:
+        chosen = {index for index, _, _ in selected_videos(summary, torrent_data)}
+        files = [(index, f) for index, f in files if index in chosen]
+    if len(files) == 0:
+        await query.edit_message_text("Error: no video files selected")
+        return ConversationHandler.END
 
-        await query.edit_message_text("Torrent downloaded")
-
-        listdir = [f for f in os.listdir(download_dir) if os.path.isdir(f"{download_dir}/{f}")]
-        if len(listdir) == 0:
-            directory = download_dir
-            files = video_files(download_dir)
-            name = files[0] if files else ""
-            sample_name = name
-            first_file = f"{download_dir}/{sample_name}"
-        elif len(listdir) == 1:
-            first_dir = listdir[0]
-            directory = f"{download_dir}/{first_dir}"
-            files = video_files(directory)
-            name = first_dir
-            sample_name = files[0] if files else ""
-            first_file = f"{directory}/{sample_name}"
-        else:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Error: multiple directories in downloads folder",
-                reply_markup=ReplyKeyboardRemove(),
-            )
-            return ConversationHandler.END
+    # Videos sent before need no download, the first one excepted, which the audio prompt and the sample read.
+    # They stay in the job for the order of the uploads.
+    cached = sorted(upload_cache.cached_files(torrent_data.get("infohash"), upload_settings()) & {index for index, _ in files[1:]})
+    download_files = [(index, f) for index, f in files if index not in cached]
+    download_need, convert_need = await blocking.run(estimate_disk, ti, download_files, download_dir)
+    need = download_need + convert_need
+    if need > disk.available():
+        await make_room(need, download_dir)
+    if need > disk.available() and not disk.busy():
+        await query.edit_message_text(
+            f"Not enough disk space: {format_size(need)} needed, {format_size(max(0, disk.available()))} available."
+        )
+        return ConversationHandler.END
 
-        if len(files) == 0:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Error: no video files in downloads folder",
-                reply_markup=ReplyKeyboardRemove(),
-            )
-            return ConversationHandler.END
+    await query.edit_message_text(downloading_text)
+    os.makedirs(download_dir, exist_ok=True)
+    os.utime(download_dir)
+    await evict_download_cache(download_dir)
+
+    sample_name = files[0][1]
+    job_data = {
+        "name": name,
+        "infohash": torrent_data.get("infohash"),
+        "sample_name": sample_name,
+        "first_file": f"{directory}/{sample_name}",
+        "directory": directory,
+        "video_files": files,
+        "cached": cached,
+        "torrent_path": file_path,
+        "download_dir": download_dir,
+    }
+    job = Job(update.effective_user.id, query.message.chat_id, torrent_data.get("torrent_name"))
+    # The job's state is kept in its record, so the user can start another torrent in the meantime
+    store.add(job.id, job.user_id, job.chat_id, job.name, file_path, download_dir, job_data)
+    disk.request(job.id, download_need, convert_need)
 
-        context.user_data["name"] = name
-        context.user_data["sample_name"] = sample_name
-        context.user_data["first_file"] = first_file
-        context.user_data["directory"] = directory
+    submit_download(context.application, job, ti, download_dir, download_files, query.message)
+    if job.state == QUEUED and not disk.fits(job.id):
+        await query.edit_message_text(
+            f"Accepted. Waiting for free disk space ({format_size(need)} needed)...\n"
+            "Type /cancel to stop downloading."
+        )
+    elif job.state == QUEUED:
+        await query.edit_message_text(
+            f"Accepted. Waiting for a free download slot (position {jobs.position(job)})...\n"
+            "Type /cancel to stop downloading."
+        )
+
+    # The job's own prompts carry its id and are handled outside the conversation
+    return ConversationHandler.END
 
-        file_title = ""
+def submit_download(application, job: Job, ti, download_dir, files, message=None, resume_data=None, prompt=True):
+    first_index = files[0][0]
+    wanted, wanted_done = 0, None
+
+    def _file_complete(index):
+        job.file_ready(index)
+        if index == first_index and prompt:
+            if message: progress.finish(message)
+            application.create_task(after_download(application, job, message))
+
+    async def _save_resume_data():
+        while True:
+            await asyncio.sleep(float(resume_data_interval))
+            if data := await torrents.resume_data(job.handle):
+                store.update(job.id, resume_data=data)
+
+    def _status(status):
+        nonlocal wanted, wanted_done
+        disk.downloaded(job.id, status.total_wanted - status.total_wanted_done)
+        download_rates[job.id] = status.download_rate
+        if wanted_done is not None:
+            metrics.inc("downloaded_bytes_total", max(0, status.total_wanted_done - wanted_done))
+        wanted, wanted_done = status.total_wanted, status.total_wanted_done
+        if message and first_index not in job.ready_files:
+            progress.update(message, download_progress_text(job.name, status, ti))
+
+    async def _download(job: Job):
+        saver = None
+        start = time.monotonic()
         try:
-            probe_info = ffmpeg.probe(first_file)
-            fmt = probe_info.get("format") or {}
-            file_title = fmt.get("tags", {}).get("title") or ""
-            streams = [s for s in (probe_info.get("streams") or []) if s.get("codec_type") == "audio"]
-
-            built_tracks = []
-            for i, s in enumerate(streams):
-                tags = s.get("tags") or {}
-                lang = (tags.get("language") or "").lower()
-                title = tags.get("title")
-                codec = s.get("codec_long_name") or s.get("codec_name")
-                channels = s.get("channels")
-                layout = s.get("channel_layout")
-
-                parts = []
-                core = []
-                if title: parts.append(title)
-                if lang: core.append(lang)
-                if codec: core.append(codec)
-                if channels: core.append(f"{channels}ch")
-                if layout: core.append(layout)
-                label = (f"{" - ".join(parts)}: " if parts else "") + f"Track {i + 1} ({", ".join(core)})"
-
-                built_tracks.append({"index": i, "label": label})
-
-            audio_tracks = built_tracks
-        except:
-            audio_tracks = []
-
-        context.user_data["audio_tracks"] = audio_tracks
-
-        if audio_tracks and len(audio_tracks) > 1:
-            keyboard = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton(a["label"], callback_data=f"audio:{a["index"]}")]
-                    for a in audio_tracks
-                ]
-            )
-            await query.edit_message_text(
-                f"{sample_name}\n{file_title}\nSelect an audio track:",
-                reply_markup=keyboard,
-            )
-            return FLOW
-
-        keyboard = InlineKeyboardMarkup(
-            [
-                [
-                    InlineKeyboardButton("Yes, continue", callback_data="sample:yes"),
-                    InlineKeyboardButton("No, cancel", callback_data="sample:no"),
-                ]
-            ]
-        )
-        await query.edit_message_text("Do you want to create a short sample (about 1 minute)?", reply_markup=keyboard)
-        downloader = None
-        return FLOW
+            if queued and message:
+                await message.edit_text(downloading_text)
+            job.handle = await blocking.run(torrents.add, ti, download_dir, resume_data)
+            saver = asyncio.create_task(_save_resume_data())
+            await torrents.download(job.handle, [index for index, _ in files], _file_complete, _status)
+        except asyncio.CancelledError:
+            if job.cancelled.is_set():
+                finish_job(job.id)
+                if first_index not in job.ready_files and message:
+                    progress.finish(message)
+                    application.create_task(message.delete())
+            raise
+        except Exception as e:
+            # A failed download is not retried, so it gives back its disk and is not resumed on restart
+            if job.handle:
+                torrents.remove(job.handle)
+            finish_job(job.id)
+            if message: progress.finish(message)
+            # Once the first file is in, the message holds the audio or sample prompt
+            status = message if first_index not in job.ready_files else None
+            await edit_or_send(application.bot, job.chat_id, status, f"Failed to download {job.name}: {e}")
+            raise
+        finally:
+            if saver: saver.cancel()
+            download_rates.pop(job.id, None)
+        torrents.remove(job.handle)
+        disk.downloaded(job.id, 0)
+        store.update(job.id, downloaded=1, resume_data=None)
+        seconds = time.monotonic() - start
+        metrics.observe("download_seconds", seconds)
+        event("download_finished", job=job.id, name=job.name, path=download_dir, files=len(files), bytes=wanted,
+              seconds=round(seconds, 3), rate=round(wanted / seconds) if seconds else None)
+
+    async def _refused(job: Job):
+        text = f"Not enough disk space for {job.name}: {format_size(disk.need(job.id))} needed, {format_size(max(0, disk.available()))} available."
+        finish_job(job.id)
+        await edit_or_send(application.bot, job.chat_id, message, text)
+
+    jobs.submit(job, _download, lambda job: application.create_task(_refused(job)))
+    queued = job.state == QUEUED
+
+async def after_download(application, job: Job, message=None):
+    record = store.get(job.id)
+    store.update(job.id, stage=READY)
+    if job.cancelled.is_set():
+        if message: await message.delete()
+        return
+
+    files = record["data"]["video_files"]
+    sample_name = record["data"]["sample_name"]
+    first_file = record["data"]["first_file"]
+    message = await edit_or_send(application.bot, job.chat_id, message, "First video downloaded" if len(files) > 1 else "Torrent downloaded")
+
+    file_title = ""
+    try:
+        probe_info = await probes.probe(first_file)
+        fmt = probe_info.get("format") or {}
+        file_title = fmt.get("tags", {}).get("title") or ""
+        streams = [s for s in (probe_info.get("streams") or []) if s.get("codec_type") == "audio"]
+
+        built_tracks = []
+        for i, s in enumerate(streams):
+            tags = s.get("tags") or {}
+            lang = (tags.get("language") or "").lower()
+            title = tags.get("title")
+            codec = s.get("codec_long_name") or s.get("codec_name")
+            channels = s.get("channels")
+            layout = s.get("channel_layout")
+
+            parts = []
+            core = []
+            if title: parts.append(title)
+            if lang: core.append(lang)
+            if codec: core.append(codec)
+            if channels: core.append(f"{channels}ch")
+            if layout: core.append(layout)
+            label = (f"{" - ".join(parts)}: " if parts else "") + f"Track {i + 1} ({", ".join(core)})"
+
+            built_tracks.append({"index": i, "label": label})
+
+        audio_tracks = built_tracks
+    except:
+        audio_tracks = []
 
-    download_task = asyncio.create_task(downloader.start_download())
-    download_task.add_done_callback(lambda _: context.application.create_task(_after_download()))
+    data = record["data"]
+    data.update(audio_tracks=audio_tracks, audio_indexes=[], audio_layout=None)
+    store.update(job.id, data=data)
 
-    return FLOW
+    if audio_tracks and len(audio_tracks) > 1:
+        await message.edit_text(
+            f"{sample_name}\n{file_title}\nSelect one or more audio tracks:",
+            reply_markup=audio_keyboard(audio_tracks, [], job.id),
+        )
+        return
 
-async def select_audio(update, context) -> int:
+    await message.edit_text("Do you want to create a short sample (about 1 minute)?", reply_markup=sample_keyboard(job.id))
+
+async def resend_cached(update, context) -> int:
     query = update.callback_query
     await query.answer()
-    data = (query.data or "")
-    try:
-        sel_index = int(data.split(":")[-1])
-    except:
-        sel_index = 0
+    cached = context.user_data.get(torrent, {}).get("cached") or []
+    await query.edit_message_text(f"Sending {len(cached)} videos from cache...")
 
-    context.user_data["selected_audio_index"] = sel_index
+    chat_id = upload_chat_id or query.message.chat_id
+    async with uploader.slot(chat_id):
+        for files in cached:
+            await send_cached(context.bot, chat_id, files)
 
-    keyboard = InlineKeyboardMarkup(
+    await query.edit_message_text(f"Sent {len(cached)} videos from cache.")
+    if upload_chat_id:
+        await context.bot.send_message(chat_id=query.message.chat_id, text=f"Video uploaded to {upload_chat_id}")
+    return ConversationHandler.END
+
+def audio_keyboard(audio_tracks: list, selected: list, job_id):
+    buttons = [
+        [InlineKeyboardButton(f"{"[x]" if a["index"] in selected else "[ ]"} {a["label"]}", callback_data=f"audio:{a["index"]}:{job_id}")]
+        for a in audio_tracks
+    ]
+    if len(selected) > 1:
+        buttons.append([
+            InlineKeyboardButton("One video, all tracks", callback_data=f"audio:{AUDIO_TRACKS}:{job_id}"),
+            InlineKeyboardButton("One video per track", callback_data=f"audio:{AUDIO_FILES}:{job_id}"),
+        ])
+    else:
+        buttons.append([InlineKeyboardButton("Continue", callback_data=f"audio:done:{job_id}")])
+    return InlineKeyboardMarkup(buttons)
+
+def sample_keyboard(job_id):
+    return InlineKeyboardMarkup(
         [
             [
-                InlineKeyboardButton("Yes, continue", callback_data="sample:yes"),
-                InlineKeyboardButton("No, cancel", callback_data="sample:no"),
+                InlineKeyboardButton("Yes, continue", callback_data=f"sample:yes:{job_id}"),
+                InlineKeyboardButton("No, cancel", callback_data=f"sample:no:{job_id}"),
             ]
         ]
     )
-    await query.edit_message_text("Do you want to create a short sample (about 1 minute)?", reply_markup=keyboard)
-    return FLOW
 
+def job_callback(query) -> tuple:
+    # The prompts of a job send "<step>:<choice>:<job id>"
+    _, choice, job_id = ((query.data or "") + "::").split(":")[:3]
+    return choice, job_id
+
+def ready_job(update, job_id) -> dict:
+    # A prompt stays in the chat, so its job may have moved on, finished or been cancelled since
+    record = store.get(job_id) if job_id else None
+    if record and record["user_id"] == update.effective_user.id and record["stage"] == READY:
+        return record
+    return None
 
-async def sample(update, context) -> int:
+async def select_audio(update, context) -> None:
     query = update.callback_query
+    choice, job_id = job_callback(query)
+    record = ready_job(update, job_id)
+    if not record:
+        await query.answer(expired_text)
+        return
+    data = record["data"]
+    selected = list(data.get("audio_indexes") or [])
+
+    if choice.isdigit():
+        index = int(choice)
+        selected = [i for i in selected if i != index] if index in selected else sorted(selected + [index])
+        data["audio_indexes"] = selected
+        store.update(job_id, data=data)
+        await query.answer()
+        try: await query.edit_message_reply_markup(audio_keyboard(data.get("audio_tracks") or [], selected, job_id))
+        except BadRequest: pass
+        return
+
+    data["audio_layout"] = AUDIO_FILES if choice == AUDIO_FILES else AUDIO_TRACKS
+    store.update(job_id, data=data)
+    await query.answer()
+    await query.edit_message_text("Do you want to create a short sample (about 1 minute)?", reply_markup=sample_keyboard(job_id))
+
+
+async def sample(update, context) -> None:
+    query = update.callback_query
+    decision, job_id = job_callback(query)
+    record = ready_job(update, job_id)
+    if not record:
+        await query.answer(expired_text)
+        return
     await query.answer()
-    decision = (query.data or "").split(":")[-1]
 
     if decision == "no":
         await query.edit_message_text("Sample processing cancelled.")
-        return await ask_remove_downloads(update, context)
+        await ask_remove_downloads(context.bot, query.message.chat_id, job_id)
+        return
 
     await query.edit_message_text("Great! Continuing sample processing...")
 
-    user_data = context.user_data
-    sample_name = user_data.get("sample_name")
-    first_file = user_data.get("first_file")
-    selected_audio_index = user_data.get("selected_audio_index")
+    data = record["data"]
+    sample_name = data.get("sample_name")
+    first_file = data.get("first_file")
+    sample_audio = audio_outputs(data)[0]
+    if isinstance(sample_audio, list):
+        sample_audio = sample_audio[0]
 
     sample_dir = f"{config_folder}/sample"
     os.makedirs(sample_dir, exist_ok=True)
-    output_path = os.path.join(sample_dir, f"{sample_name}.mp4")
-
-    pipeline = ffmpeg_pipeline(first_file, output_path, selected_audio_index, True)
+    # Users of the same torrent share its download, so every sample gets its own file
+    output_path = os.path.join(sample_dir, f"{sample_name}.{job_id}.mp4")
 
     try:
-        await asyncio.to_thread(pipeline.run)
+        first_probe = await probes.probe(first_file)
+        pipeline = sample_pipeline(first_file, output_path, sample_audio, first_probe)
+        await conversions.run([pipeline], True, priority=INTERACTIVE, user=update.effective_user.id)
     except ffmpeg.Error as e:
         err_msg = e.stderr.decode("utf-8", errors="ignore") if hasattr(e, "stderr") and e.stderr else str(e)
         await query.edit_message_text(
             f"Failed to convert video via ffmpeg.\n{err_msg[-1200:]}"
         )
-        return ConversationHandler.END
+        return
 
     await query.edit_message_text(f"Sample created: {output_path}.\nUploading...")
 
-    probe = ffmpeg.probe(output_path)
-    fmt = probe.get("format") or {}
-    duration = float(fmt.get("duration") or 0.0)
-    width_and_height = width_height(probe)
-    width, height = width_and_height.split("x")
+    width_and_height = width_height(await probes.probe(output_path))
 
     keyboard = InlineKeyboardMarkup(
         [
             [
-                InlineKeyboardButton("Yes, continue", callback_data="upload:yes"),
-                InlineKeyboardButton("No, cancel", callback_data="upload:no"),
+                InlineKeyboardButton("Yes, continue", callback_data=f"upload:yes:{job_id}"),
+                InlineKeyboardButton("No, cancel", callback_data=f"upload:no:{job_id}"),
             ]
         ]
     )
 
-    await context.bot.send_video(
-        chat_id=query.message.chat_id,
-        video=open(output_path, "rb"),
-        width=width,
-        height=height,
-        duration=duration,
-        caption=f"Sample of {sample_name}\nOriginal: {width_height(ffmpeg.probe(first_file))}\nScaled: {width_and_height}\nUpload full version?",
+    await send_video(
+        context.bot, query.message.chat_id, f"{sample_name}.mp4", output_path,
+        caption=f"Sample of {sample_name}\nOriginal: {width_height(first_probe)}\nScaled: {width_and_height}\nUpload full version?",
         reply_markup=keyboard,
     )
-    shutil.rmtree(sample_dir, ignore_errors=True)
+    await blocking.run(os.remove, output_path)
 
-    return FLOW
-
-async def upload(update, context) -> int:
+async def upload(update, context) -> None:
     query = update.callback_query
+    decision, job_id = job_callback(query)
+    record = ready_job(update, job_id)
+    if not record:
+        await query.answer(expired_text)
+        return
     await query.answer()
 
-    user_data = context.user_data
-    name = user_data.get("name")
-    sample_name = user_data.get("sample_name")
-    directory = user_data.get("directory")
-    selected_audio_index = user_data.get("selected_audio_index")
+    job_data = record["data"]
+    sample_name = job_data.get("sample_name")
 
     message = query.message
     caption_text = f"Sample of {sample_name}"
@@ -384,157 +805,613 @@ async def upload(update, context) -> int:
             await message.edit_text(text=caption_text, reply_markup=None)
     except: pass
 
-    decision = (query.data or "").split(":")[-1]
-
     if decision == "no":
         await context.bot.send_message(
             chat_id=query.message.chat_id,
             text="Upload cancelled.",
             reply_markup=ReplyKeyboardRemove(),
         )
-        return await ask_remove_downloads(update, context)
+        await ask_remove_downloads(context.bot, query.message.chat_id, job_id)
+        return
 
+    # Moved on before the first await, so a second press of the button finds the job no longer ready
+    store.update(job_id, stage=UPLOAD)
     message = await context.bot.send_message(
         chat_id=query.message.chat_id,
         text="Great! Converting original video to mp4...",
         reply_markup=ReplyKeyboardRemove(),
     )
 
-    upload_dir = f"{config_folder}/upload/{directory}"
+    job = jobs.jobs.get(job_id)
+    # Uploads can take hours, so the handler returns right away and the task asks about removing the files
+    run_in_background(upload_and_ask(context.bot, query.message.chat_id, job, job_data, message))
+async def convert_and_upload(bot: Bot, reply_chat_id, job: Job, job_data: dict, message=None, uploaded=()):
+    name = job_data.get("name")
+    directory = job_data.get("directory")
+    infohash = job_data.get("infohash")
+    skipped = set(job_data.get("cached") or [])
+    outputs = audio_outputs(job_data)
+    settings = upload_settings()
+    uploaded = set(uploaded)
+
+    upload_dir = f"{config_folder}/upload/{job.id}" if job else f"{config_folder}/upload/{directory}"
     os.makedirs(upload_dir, exist_ok=True)
-
-    for f in video_files(directory):
-        pipeline = ffmpeg_pipeline(os.path.join(directory, f), os.path.join(upload_dir, f"{f}.mp4"), selected_audio_index, False)
-        await asyncio.to_thread(pipeline.run)
-
-    files = sorted([file for file in os.listdir(upload_dir) if file.endswith('.mp4')])
-    len_files = len(files)
-    videos = f" {len_files} videos" if len_files > 1 else ""
-    text = f"- Successfully converted:\n{name}.\nUploading{videos}..."
+    files = job_data.get("video_files") or [(None, f) for f in sorted(await blocking.run(video_files, directory))]
+    chat_id = upload_chat_id or reply_chat_id
+    # Conversions are shared fairly between users, not between jobs or files
+    user = job.user_id if job else reply_chat_id
+    statuses = {}
+
+    def _report(f, status=None):
+        if status:
+            statuses[f] = status
+        else:
+            statuses.pop(f, None)
+        if message:
+            lines = [f"Converting and uploading {name}: {len(uploaded)}/{len(files)} uploaded"]
+            lines += [f"- {f}: {status}" for f, status in statuses.items()]
+            progress.update(message, "\n".join(lines))
+
+    async def _convert(index, f):
+        cached = {}
+        if infohash and index is not None:
+            for audio in outputs:
+                if files := upload_cache.get(infohash, index, audio, settings):
+                    cached[str(audio)] = files
+        if len(cached) == len(outputs):
+            return [(audio, cached[str(audio)], True) for audio in outputs]
+        if index in skipped:
+            # Left out of the download as cached, but not with the audio tracks chosen since
+            _report(f, "downloading")
+            await fetch_file(job_data, index)
+        else:
+            _report(f, "waiting for download")
+            if job and (not await job.wait_file(index) or job.cancelled.is_set()):
+                return None
+        input_path = os.path.join(directory, f)
+        input_probe = await probes.probe(input_path)
+        duration = float((input_probe.get("format") or {}).get("duration") or 0.0)
+        targets = [
+            (audio, output_name(f, audio, input_probe, len(outputs) > 1))
+            for audio in outputs if str(audio) not in cached
+        ]
+        paths = [(os.path.join(upload_dir, file), audio) for audio, file in targets]
+        plan = plan_encode(input_probe, len(targets[0][0]) if isinstance(targets[0][0], list) else 1)
+        mode = REMUX if plan["vcodec"] == "copy" else TRANSCODE
+        segmented = mode == TRANSCODE and not plan["two_pass"] and int(segment_workers) > 1 and duration >= float(segment_min_duration)
+        segments_dir = f"{paths[0][0]}.segments"
+        pipelines = [ffmpeg_pipeline(input_path, paths, plan, input_probe)]
+        if plan["two_pass"]:
+            pipelines.insert(0, ffmpeg_first_pass(input_path, paths[0][0], plan))
+        last_status = {}
+        segment_times = {}
+        staged = None
+        if mode == REMUX and len(paths) == 1 and can_send_as_is(input_probe, paths[0][1]) and await blocking.run(is_faststart, input_path):
+            # The remux would write the same bytes again, so the upload gets a link to the download instead
+            staged = await blocking.run(link_file, input_path, paths[0][0])
+        if staged:
+            mode, pipelines = staged, []
+
+        def _progress(pass_index, status):
+            last_status.update(status)
+            if segmented and "segment" in status:
+                segment_times[status["segment"]] = progress_value(status, "out_time_us") or 0.0
+                done = {"out_time_us": str(int(sum(segment_times.values())))}
+                _report(f, convert_progress_text(done, duration) + f" in {len(pipelines[0])} segments")
+            elif segmented:
+                _report(f, convert_progress_text(status, duration) + ", joining segments")
+            else:
+                passes = f", pass {pass_index + 1}/{len(pipelines)}" if len(pipelines) > 1 else ""
+                _report(f, convert_progress_text(status, duration) + passes)
+
+        start = time.monotonic()
+        try:
+            if segmented:
+                _report(f, "splitting into segments")
+                pipelines = await segment_pipelines(input_path, paths, plan, input_probe, duration, segments_dir, user)
+            if pipelines:
+                _report(f, "waiting for a converter")
+                await conversions.run(pipelines, mode == TRANSCODE, _progress, int(segment_workers), user=user)
+        finally:
+            for log in glob.glob(f"{glob.escape(paths[0][0])}.passlog*"):
+                os.remove(log)
+            if segmented:
+                await blocking.cleanup(shutil.rmtree, segments_dir, ignore_errors=True)
+        seconds = time.monotonic() - start
+        speed, fps = progress_value(last_status, "speed"), progress_value(last_status, "fps")
+        if segmented:
+            # The last status is the one of joining the segments, not of the encode
+            speed, fps = round(duration / seconds, 2) if seconds else None, None
+        metrics.inc("conversions_total", mode=mode)
+        metrics.observe("convert_seconds", seconds, mode=mode)
+        if speed:
+            metrics.observe("convert_speed", speed, mode=mode)
+        if fps and mode == TRANSCODE:
+            metrics.observe("encode_fps", fps)
+        sizes = await asyncio.gather(*(blocking.run(os.path.getsize, path) for path, _ in paths))
+        event("converted", job=job.id if job else None, file=f, mode=mode, outputs=len(paths), passes=len(pipelines),
+              segments=len(pipelines[0]) if segmented else None, duration=duration, seconds=round(seconds, 3), speed=speed, fps=fps, bytes=sum(sizes))
+
+        _report(f, "preparing upload")
+        converted = {}
+        for audio, file in targets:
+            parts = await split_video(os.path.join(upload_dir, file), user)
+            if len(parts) == 1:
+                converted[str(audio)] = [(file, parts[0], await make_thumbnail(parts[0]))]
+            else:
+                stem = file.removesuffix(".mp4")
+                converted[str(audio)] = [(f"{stem}.part{number}.mp4", part, await make_thumbnail(part)) for number, part in enumerate(parts, 1)]
+        return [(audio, cached[str(audio)], True) if str(audio) in cached else (audio, converted[str(audio)], False) for audio in outputs]
+
+    async def _upload(index, f, results):
+        file = f"{f}.mp4"
+        try:
+            async with uploader.slot(chat_id):
+                for audio, parts, cached in results:
+                    if cached:
+                        _report(f, "sending from cache")
+                        await send_cached(bot, chat_id, parts)
+                        continue
+                    sent = []
+                    for number, (file, path, thumbnail) in enumerate(parts, 1):
+                        _report(f, f"uploading part {number}/{len(parts)}" if len(parts) > 1 else "uploading")
+                        video_message = await uploader.send(send_video, bot, chat_id, file, path, thumbnail)
+                        sent.append([file, video_message.video.file_id if video_message and video_message.video else None])
+                        await blocking.run(os.remove, path)
+                    if infohash and index is not None and sent and all(file_id for _, file_id in sent):
+                        upload_cache.put(infohash, index, audio, settings, sent)
+            uploaded.add(index)
+            succeeded.append(f)
+            _report(f)
+            if job:
+                store.update(job.id, uploaded=uploaded)
+        except Exception:
+            _report(f)
+            await send_message(bot, reply_chat_id, f"Failed to upload video file: {file}")
+            raise
+        finally:
+            slots.release()
+
+    converted = asyncio.Queue()
+    slots = asyncio.Semaphore(int(convert_ahead))
+
+    async def _produce():
+        for index, f in files:
+            if index in uploaded:
+                continue
+            await slots.acquire()
+            converted.put_nowait((index, f, asyncio.create_task(_convert(index, f))))
+        converted.put_nowait(None)
+
+    producer = asyncio.create_task(_produce())
+    uploads = []
+    succeeded, failed, cancelled = [], [], False
+    previously = len(uploaded)
     try:
-        await context.bot.edit_message_text(
-            chat_id=message.chat_id,
-            message_id=message.message_id,
-            text=text,
-        )
-    except:
-        await context.bot.send_message(chat_id=query.message.chat_id, text=text)
-
-    chat_id = upload_chat_id or query.message.chat_id
+        while item := await converted.get():
+            index, f, task = item
+            try:
+                result = await task
+            except Exception as e:
+                # Like a failed upload, a failed conversion only fails its own file
+                print(f"Error: {e}")
+                _report(f)
+                slots.release()
+                failed.append(f)
+                await send_message(bot, reply_chat_id, f"Failed to convert video file: {f}")
+                continue
+            if result is None:
+                cancelled = True
+                break
+            uploads.append((f, asyncio.create_task(_upload(index, f, result))))
+        results = await asyncio.gather(*(task for _, task in uploads), return_exceptions=True)
+        failed += [f for (f, _), result in zip(uploads, results) if isinstance(result, Exception)]
+    finally:
+        producer.cancel()
+        for _, upload_task in uploads:
+            upload_task.cancel()
+        while not converted.empty():
+            if item := converted.get_nowait():
+                item[2].cancel()
 
-    for file in files:
-        await retry(
-            target=send_video,
-            target_args=(context.bot, chat_id, file, os.path.join(upload_dir, file)),
-            error_target=send_message,
-            error_target_args=(context.bot, query.message.chat_id, f"Failed to upload video file: {file}"),
-            retries=3,
-        )
-    shutil.rmtree(upload_dir, ignore_errors=True)
-    print(f"Uploaded {name}, upload folder removed: {upload_dir}")
-
-    if upload_chat_id:
-        await context.bot.send_message(chat_id=query.message.chat_id, text=f"Video uploaded to {upload_chat_id}")
-
-    return await ask_remove_downloads(update, context)
-
-async def ask_remove_downloads(update, context) -> int:
-    text = "Do you want to remove the downloaded files?"
-    keyboard = InlineKeyboardMarkup(
+    len_files = len(files)
+    done = previously + len(succeeded)
+    if cancelled:
+        text = f"- Upload of {name} cancelled after {done} of {len_files} videos."
+    elif failed:
+        text = f"- Uploaded {done} of {len_files} videos of {name}.\nFailed: {", ".join(failed)}"
+    else:
+        videos = f" {len_files} videos" if len_files > 1 else ""
+        text = f"- Successfully converted and uploaded{videos}:\n{name}."
+    if message: progress.finish(message)
+    await edit_or_send(bot, reply_chat_id, message, text)
+
+    await blocking.cleanup(shutil.rmtree, upload_dir, ignore_errors=True)
+    event("upload_finished", job=job.id if job else None, name=name, files=done, failed=len(failed), cancelled=cancelled,
+          chat=chat_id, upload_dir=upload_dir)
+
+    if upload_chat_id and done:
+        await bot.send_message(chat_id=reply_chat_id, text=f"Video uploaded to {upload_chat_id}")
+    if job:
+        finish_job(job.id)
+
+async def ask_remove_downloads(bot: Bot, chat_id, job_id):
+    await bot.send_message(chat_id, "Do you want to remove the downloaded files?", reply_markup=remove_downloads_keyboard(job_id))
+
+def remove_downloads_keyboard(job_id):
+    # The prompt can be answered long after it was sent, so it names its job instead of the user's latest one
+    return InlineKeyboardMarkup(
         [
             [
-                InlineKeyboardButton("Yes, proceed", callback_data="remove:yes"),
-                InlineKeyboardButton("No, cancel", callback_data="remove:no"),
+                InlineKeyboardButton("Yes, proceed", callback_data=f"remove:yes:{job_id}"),
+                InlineKeyboardButton("No, cancel", callback_data=f"remove:no:{job_id}"),
             ]
         ]
     )
-    try: await update.message.reply_text(text, reply_markup=keyboard)
-    except: await context.bot.send_message(update.callback_query.message.chat_id, text, reply_markup=keyboard)
-    return FLOW
 
 
-async def remove_downloads(update, context) -> int:
+async def remove_downloads(update, context) -> None:
     query = update.callback_query
     await query.answer()
-    decision = (query.data or "").split(":")[-1]
+    decision, job_id = job_callback(query)
+    record = store.get(job_id) if job_id else None
+    if record and record["user_id"] != update.effective_user.id:
+        record = None
+    job = jobs.jobs.get(job_id)
+    if job and decision != "no":
+        jobs.cancel(job.id)
+    if record:
+        finish_job(job_id)
 
     if decision == "no":
         try: await query.message.delete()
         except: pass
-        return ConversationHandler.END
+        return
 
-    download_dir = context.user_data.get(torrent, {}).get("download_dir")
+    if not record:
+        await query.edit_message_text("This download is no longer known, nothing was removed.")
+        return
+    download_dir = record["download_dir"]
 
-    shutil.rmtree(download_dir, ignore_errors=True)
-    text = f"Download folder removed: {download_dir}"
-    print(text)
-    await query.edit_message_text(text)
-    return ConversationHandler.END
+    # Downloads are shared by infohash, so another user's job may still be reading or writing the folder
+    if any(record["download_dir"] == download_dir for record in store.unfinished()):
+        await query.edit_message_text("The download folder is still used by another job, so it was kept.")
+        return
+
+    await blocking.cleanup(shutil.rmtree, download_dir, ignore_errors=True)
+    event("download_removed", job=job_id, path=download_dir)
+    await query.edit_message_text(f"Download folder removed: {download_dir}")
 
-async def send_video(bot: Bot, chat_id: str, file: str, video: str):
-    probe = ffmpeg.probe(video)
+async def send_video(bot: Bot, chat_id: str, file: str, video: str, thumbnail: str = None, caption: str = None, reply_markup=None):
+    probe = await probes.probe(video)
     try:
         duration = float(probe['format']['duration'])
     except:
         duration = None
     width_and_height = width_height(probe)
     width, height = width_and_height.split("x")
-    await bot.send_video(
-        chat_id=chat_id,
-        caption=file,
-        video=video,
-        filename=file,
-        duration=duration,
-        width=width,
-        height=height,
+    kwargs = {"chat_id": chat_id, "caption": caption or file, "filename": file, "duration": duration, "width": width, "height": height,
+              "reply_markup": reply_markup}
+    size = await blocking.run(os.path.getsize, video)
+    start = time.monotonic()
+
+    video_uri = server_uri(video, server_paths)
+    if video_uri:
+        thumbnail_uri = server_uri(thumbnail, server_paths) if thumbnail else None
+        try:
+            sent = await bot.send_video(video=video_uri, thumbnail=thumbnail_uri, **kwargs)
+            record_upload("path", file, size, time.monotonic() - start)
+            return sent
+        except BadRequest as e:
+            print(f"Local upload of {video} failed, streaming it instead: {e}")
+
+    start = time.monotonic()
+    sent = await bot.send_video(
+        video=await blocking.run(read_bytes, video),
+        thumbnail=await blocking.run(read_bytes, thumbnail) if thumbnail else None,
+        **kwargs,
     )
+    record_upload("stream", file, size, time.monotonic() - start)
+    return sent
+
+def record_upload(mode: str, file: str, size: int, seconds: float):
+    metrics.inc("uploads_total", mode=mode)
+    metrics.inc("upload_bytes_total", size, mode=mode)
+    metrics.observe("upload_seconds", seconds, mode=mode)
+    event("uploaded", file=file, mode=mode, bytes=size, seconds=round(seconds, 3), rate=round(size / seconds) if seconds else None)
+
+async def send_cached(bot: Bot, chat_id: str, files: list):
+    for file, file_id in files:
+        start = time.monotonic()
+        await uploader.send(bot.send_video, chat_id=chat_id, video=file_id, caption=file)
+        record_upload("cache", file, 0, time.monotonic() - start)
+
+async def evict_download_cache(download_dir: str):
+    if not int(download_cache_quota):
+        return
+    keep = [record["download_dir"] for record in store.unfinished()] + [download_dir]
+    evicted = await blocking.run(evict_downloads, f"{config_folder}/download", int(download_cache_quota) << 30, keep)
+    for path in evicted:
+        print(f"Evicted cached download: {path}")
+
+def finish_job(job_id):
+    rooms_made.discard(job_id)
+    store.update(job_id, stage=DONE)
+    store.prune(float(stale_age) * 3600)
+    disk.release(job_id)
+    jobs.forget(job_id)
+    jobs.dispatch()
+
+def refuse_job(job: Job) -> bool:
+    # With nothing reserved no running job can free space for the job at the head of the queue.
+    # Make room once, and if it still does not fit, refuse it so the queue moves on.
+    if disk.busy():
+        return False
+    if job.id not in rooms_made:
+        rooms_made.add(job.id)
+        asyncio.create_task(make_room_and_dispatch(disk.need(job.id)))
+        return False
+    rooms_made.discard(job.id)
+    return True
+
+async def make_room_and_dispatch(need: int):
+    await make_room(need)
+    jobs.dispatch()
+
+async def recheck_disk():
+    # Space freed outside the bot does not trigger a dispatch, so jobs waiting for disk are retried periodically
+    while True:
+        await asyncio.sleep(30)
+        jobs.dispatch()
+
+def estimate_disk(ti: lt.torrent_info, files, download_dir: str):
+    storage = ti.files()
+    sizes = [storage.file_size(index) for index, _ in files]
+    download = max(0, sum(sizes) - (folder_size(download_dir) if os.path.isdir(download_dir) else 0))
+    return download, conversion_estimate(sizes, int(convert_ahead), int(upload_size_limit) << 20)
+
+async def make_room(need: int, keep_dir: str = None):
+    unfinished = store.unfinished()
+    keep = [keep_dir] if keep_dir else []
+    for record in unfinished:
+        keep += [record["download_dir"], record["torrent_path"], f"{config_folder}/upload/{record['id']}"]
+    folders = [f"{config_folder}/{folder}" for folder in ("torrent", "sample", "upload")]
+    evicted = await blocking.run(evict_stale, folders, float(stale_age) * 3600, keep)
+    if (shortfall := need - disk.available()) > 0:
+        evicted += await blocking.run(evict_downloads, f"{config_folder}/download", None, keep, shortfall)
+    for path in evicted:
+        print(f"Evicted: {path}")
+
+def upload_settings() -> str:
+    return f"{upload_size_limit}:{encode_crf}:{encode_preset}:{int(encode_two_pass)}"
+
+async def segment_pipelines(input_path: str, outputs, plan, probe, duration: float, segments_dir: str, user=None) -> list:
+    # Chunked encode: the video is cut at keyframes without re-encoding, the pieces are encoded side by side,
+    # then joined by the concat demuxer while the audio is encoded once from the original file
+    await blocking.run(os.makedirs, segments_dir, exist_ok=True)
+    workers = int(segment_workers)
+    segment_seconds = max(MIN_SEGMENT_SECONDS, duration / (workers * SEGMENTS_PER_WORKER))
+    await conversions.run([segment_split_pipeline(input_path, f"{segments_dir}/source%04d.mkv", segment_seconds)], False, user=user)
+    sources = sorted(glob.glob(f"{glob.escape(segments_dir)}/source*.mkv"))
+    encoded = [f"{segments_dir}/encoded{number:04d}.mkv" for number in range(len(sources))]
+    list_path = f"{segments_dir}/segments.txt"
+    await blocking.run(write_bytes, list_path, concat_list(encoded))
+    # Every segment runs in a transcode slot, so it gets the CPU share of one slot
+    threads = max(1, (os.cpu_count() or 1) // int(transcode_workers))
+    return [
+        [segment_encode_pipeline(source, output, plan, threads) for source, output in zip(sources, encoded)],
+        ffmpeg_pipeline(input_path, outputs, plan, probe, ffmpeg.input(list_path, format="concat", safe=0)),
+    ]
+
+async def split_video(path: str, user=None) -> list[str]:
+    size = await blocking.run(os.path.getsize, path)
+    limit = int(upload_size_limit) << 20
+    if size <= limit:
+        return [path]
+    duration = float(((await probes.probe(path)).get("format") or {}).get("duration") or 0.0)
+    if duration <= 0:
+        return [path]
+    prefix = path.removesuffix(".mp4")
+    segment_seconds = segment_time(duration, size, limit)
+    for _ in range(3):
+        for part in glob.glob(f"{glob.escape(prefix)}.part*.mp4"):
+            await blocking.run(os.remove, part)
+        await conversions.run([split_pipeline(path, f"{prefix}.part%03d.mp4", segment_seconds)], False, user=user)
+        parts = sorted(glob.glob(f"{glob.escape(prefix)}.part*.mp4"))
+        largest = max(await asyncio.gather(*(blocking.run(os.path.getsize, part) for part in parts)))
+        if largest <= limit:
+            break
+        # Parts end on the first keyframe after the cut point, so shrink the segments and try again
+        segment_seconds = segment_time(segment_seconds, largest, limit)
+    await blocking.run(os.remove, path)
+    return parts
+
+async def fetch_file(job_data: dict, index: int):
+    ti = await read_torrent(job_data["torrent_path"])
+    handle = await blocking.run(torrents.add, ti, job_data["download_dir"])
+    await torrents.download(handle, [index])
+    torrents.remove(handle)
+
+async def make_thumbnail(path: str):
+    thumbnail = f"{path}.jpg"
+    try:
+        duration = float(((await probes.probe(path)).get("format") or {}).get("duration") or 0.0)
+        await run_ffmpeg(thumbnail_pipeline(path, thumbnail, duration))
+        return thumbnail
+    except ffmpeg.Error as e:
+        print(f"Error: {e}")
+        return None
 
 async def send_message(bot: Bot, chat_id: str, text: str):
     await bot.send_message(chat_id=chat_id, text=text)
 
-async def retry(
-    target = None, target_args = (),
-    error_target = None, error_target_args = (),
-    retries = 3,
-):
-    for i in range(retries):
+async def edit_or_send(bot: Bot, chat_id, message, text: str, reply_markup=None):
+    if message:
         try:
-            await target(*target_args)
-            break
+            return await message.edit_text(text, reply_markup=reply_markup)
         except Exception as e:
             print(f"Error: {e}")
-            if i == retries - 1:
-                if error_target: await error_target(*error_target_args)
-                raise e
+    return await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def format_time(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def download_progress_text(name: str, status, ti: lt.torrent_info) -> str:
+    remaining = status.total_wanted - status.total_wanted_done
+    eta = format_time(remaining / status.download_rate) if status.download_rate else "unknown"
+    return (
+        f"Downloading {name}\n"
+        f"{status.progress * 100:.1f}% of {format_size(status.total_wanted)} at {format_size(status.download_rate)}/s\n"
+        f"Peers: {status.num_peers} ({status.num_seeds} seeds), ETA: {eta}\n"
+        f"Pieces: {status.num_pieces}/{ti.num_pieces()}\n"
+        "Type /cancel to stop downloading."
+    )
+
+def convert_progress_text(status: dict, duration: float) -> str:
+    try:
+        out_time = int(status.get("out_time_us")) / 1_000_000
+    except:
+        out_time = 0.0
+    done = f"{min(out_time / duration, 1.0) * 100:.0f}%" if duration else format_time(out_time)
+    speed = status.get("speed", "").strip()
+    return f"converting {done}" + (f" at {speed}" if speed and speed != "N/A" else "")
+
+def progress_value(status: dict, key: str):
+    try:
+        return float(status.get(key, "").strip().removesuffix("x"))
+    except ValueError:
+        return None
 
 def video_files(path: str):
     return [f for f in os.listdir(path) if f.lower().endswith(video_exts)]
 
+def torrent_layout(summary: dict, download_dir: str):
+    multi_file = summary["multi_file"]
+    name = summary["name"]
+    directory = f"{download_dir}/{name}" if multi_file else download_dir
+    files = [(index, file) for index, file, _ in summary["videos"]]
+    if not multi_file and files:
+        name = files[0][1]
+    return name, directory, files
+
+async def resume_jobs(application):
+    await make_room(0)
+    run_in_background(recheck_disk())
+    for record in store.unfinished():
+        job = Job(record["user_id"], record["chat_id"], record["name"], job_id=record["id"])
+        data = record["data"]
+        files = [(index, f) for index, f in data["video_files"] if index not in data.get("cached", [])]
+        if record["downloaded"]:
+            job.state = JOB_DONE
+            job.ready_files.update(index for index, _ in files)
+            jobs.jobs[job.id] = job
+        else:
+            try:
+                ti = await read_torrent(record["torrent_path"])
+            except Exception as e:
+                print(f"Cannot resume job {job.id}: {e}")
+                finish_job(job.id)
+                continue
+            disk.request(job.id, *await blocking.run(estimate_disk, ti, files, record["download_dir"]))
+            submit_download(application, job, ti, record["download_dir"], files,
+                            resume_data=record["resume_data"], prompt=record["stage"] == DOWNLOAD)
+        print(f"Resumed job {job.id}: {job.name} ({record['stage']})")
+
+        if record["stage"] == UPLOAD:
+            run_in_background(resume_upload(application, job, record))
+        elif record["stage"] == DOWNLOAD and not record["downloaded"]:
+            await application.bot.send_message(job.chat_id, f"Bot restarted, resuming download of {job.name}")
+
+async def resume_upload(application, job: Job, record):
+    bot = application.bot
+    message = await bot.send_message(job.chat_id, f"Bot restarted, resuming upload of {job.name}...")
+    await upload_and_ask(bot, job.chat_id, job, record["data"], message, record["uploaded"])
+
+async def upload_and_ask(bot: Bot, chat_id, job: Job, job_data: dict, message=None, uploaded=()):
+    try:
+        await convert_and_upload(bot, chat_id, job, job_data, message, uploaded)
+    except Exception as e:
+        print(f"Upload of {job_data.get('name')} failed: {e}")
+    # Not asked when cancelled at shutdown, the upload resumes on the next start
+    await ask_remove_downloads(bot, chat_id, job.id if job else None)
+
+def run_in_background(coroutine) -> asyncio.Task:
+    # Not application.create_task, whose tasks the application waits for on stop
+    task = asyncio.create_task(coroutine)
+    background.add(task)
+    task.add_done_callback(background.discard)
+    return task
+
+async def stop_background(_):
+    # Upload progress is in the store, so long tasks are cancelled rather than holding up the shutdown
+    tasks = list(background)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def save_resume_data(_):
+    for job in list(jobs.jobs.values()):
+        if job.state == RUNNING and job.handle and (data := await torrents.resume_data(job.handle)):
+            store.update(job.id, resume_data=data)
+
 def main():
+    global store, upload_cache
+    os.makedirs(config_folder, exist_ok=True)
+    store = JobStore(f"{config_folder}/jobs.db")
+    upload_cache = UploadCache(f"{config_folder}/cache.db", int(upload_cache_size))
+    if int(metrics_port):
+        metrics.serve(metrics_host, int(metrics_port))
     application = (
         Application.builder()
         .token(token)
         .base_url(f"{base_url}/bot")
         .read_timeout(float(timeout))
+        .local_mode(local_api)
+        .persistence(PicklePersistence(f"{config_folder}/conversations.pickle"))
+        .post_init(resume_jobs)
+        .post_stop(stop_background)
+        .post_shutdown(save_resume_data)
+        .concurrent_updates(True)
         .build()
     )
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help))
-    application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CommandHandler("jobs", list_jobs))
 
     application.add_handler(ConversationHandler(
-        entry_points=[MessageHandler(filters.ATTACHMENT, select_torrent)],
+        entry_points=[
+            MessageHandler(filters.ATTACHMENT, select_torrent),
+            MessageHandler(filters.TEXT & filters.Regex(r"^\s*(magnet:\?|https?://)"), select_link),
+        ],
         states={
             FLOW: [
                 CallbackQueryHandler(accept_torrent, pattern="^accept:"),
-                CallbackQueryHandler(select_audio, pattern="^audio:"),
-                CallbackQueryHandler(sample, pattern="^sample:"),
-                CallbackQueryHandler(upload, pattern="^upload:"),
-                CallbackQueryHandler(remove_downloads, pattern="^remove:"),
+                CallbackQueryHandler(resend_cached, pattern="^cached:"),
+                CallbackQueryHandler(select_files, pattern="^file:"),
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="flow",
+        persistent=True,
+        # A new torrent always starts over, so a flow left hanging never locks the user out
+        allow_reentry=True,
     ))
+    # The prompts of a job carry its id, so they work whichever torrent the user is looking at now
+    application.add_handler(CallbackQueryHandler(select_audio, pattern="^audio:"))
+    application.add_handler(CallbackQueryHandler(sample, pattern="^sample:"))
+    application.add_handler(CallbackQueryHandler(upload, pattern="^upload:"))
+    application.add_handler(CallbackQueryHandler(remove_downloads, pattern="^remove:"))
+    # Only reached outside a conversation, inside one the fallback ends it
+    application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(MessageHandler(filters.COMMAND, unknown))
 
     application.run_polling()
@@ -549,58 +1426,168 @@ def width_height(probe):
         height = None
     return f"{width}x{height}"
 
-def ffmpeg_pipeline(input_file, output_file, selected_audio_index, create_sample):
-    if create_sample:
-        probe = ffmpeg.probe(input_file)
-        fmt = probe.get("format") or {}
-        duration = float(fmt.get("duration") or 0.0)
-        if duration <= 0:
-            start_sec = 0.0
-        else:
-            start_sec = max(0.0, duration * 0.10)
-        input_stream = ffmpeg.input(input_file, ss=start_sec)
-    else:
-        input_stream = ffmpeg.input(input_file)
+def plan_encode(probe, audio_tracks=1):
+    return encode_plan(probe, int(upload_size_limit) << 20, int(encode_crf), encode_two_pass, audio_tracks)
 
+def scaled_video(input_stream, plan):
     video = input_stream.video
-    if os.path.getsize(input_file) >> 20 > 4000:
-        v_stream = video.filter("scale", "round(iw/4)*2", "round(ih/4)*2")
+    if plan["height"]:
+        return video.filter("scale", -2, plan["height"])
+    return video
+
+def ffmpeg_first_pass(input_file, output_file, plan):
+    return ffmpeg.output(
+        scaled_video(ffmpeg.input(input_file), plan),
+        os.devnull,
+        format="null",
+        passlogfile=f"{output_file}.passlog",
+        **{"pass": 1},
+        **video_args(plan, encode_preset),
+    ).overwrite_output()
+
+def audio_stream(input_stream, selected_audio_index):
+    if isinstance(selected_audio_index, int):
+        return input_stream[f"a:{selected_audio_index}"]
+    return input_stream.audio
+
+def sample_pipeline(input_file, output_file, selected_audio_index, probe):
+    fmt = probe.get("format") or {}
+    duration = float(fmt.get("duration") or 0.0)
+    if duration <= 0:
+        start_sec = 0.0
     else:
-        v_stream = video
-    if os.path.getsize(input_file) >> 20 > 2000:
-        vcodec = "libx264"
+        start_sec = max(0.0, duration * 0.10)
+    input_stream = ffmpeg.input(input_file, ss=start_sec)
+
+    stream = video_stream(probe)
+    if can_copy_video(stream):
+        v_stream = input_stream.video
+        v_args = {"vcodec": "copy", "avoid_negative_ts": "make_zero"}
     else:
-        vcodec = "copy"
-    if isinstance(selected_audio_index, int):
-        a_stream = input_stream[f"a:{selected_audio_index}"]
+        height = int(stream.get("height") or 0)
+        v_stream = input_stream.video
+        if height > int(sample_height):
+            v_stream = v_stream.filter("scale", -2, int(sample_height))
+        v_args = {"vcodec": "libx264", "preset": "veryfast", "crf": 28, "pix_fmt": "yuv420p"}
+
+    return ffmpeg.output(
+        v_stream,
+        audio_stream(input_stream, selected_audio_index),
+        output_file,
+        t=int(sample_length),
+        acodec="aac",
+        movflags="+faststart",
+        format="mp4",
+        shortest=None,
+        **v_args,
+    ).overwrite_output()
+
+def audio_outputs(data: dict) -> list:
+    # One entry per output video: None for the default track, a track index, or a list of tracks in one video
+    indexes = data.get("audio_indexes")
+    if indexes is None and isinstance(data.get("selected_audio_index"), int):
+        indexes = [data["selected_audio_index"]]
+    if not indexes:
+        return [None]
+    if len(indexes) == 1:
+        return [indexes[0]]
+    if data.get("audio_layout") == AUDIO_FILES:
+        return list(indexes)
+    return [list(indexes)]
+
+def output_name(file: str, audio, probe, several: bool) -> str:
+    if not several or not isinstance(audio, int):
+        return f"{file}.mp4"
+    streams = audio_streams(probe)
+    language = ((streams[audio].get("tags") or {}).get("language") or "").lower() if audio < len(streams) else ""
+    return f"{file}.audio{audio + 1}" + (f".{language}" if language and language != "und" else "") + ".mp4"
+
+def audio_codec(probe, audio) -> str:
+    streams = audio_streams(probe)
+    if isinstance(audio, int):
+        stream = streams[audio] if audio < len(streams) else {}
     else:
-        a_stream = input_stream.audio
-
-    if create_sample:
-        output = ffmpeg.output(
-            v_stream,
-            a_stream,
-            output_file,
-            t=120,
-            vcodec=vcodec,
-            acodec="aac",
-            movflags="+faststart",
-            format="mp4",
-            shortest=None,
-        )
+        stream = streams[0] if len(streams) == 1 else {}
+    return "copy" if can_copy_audio(stream) else "aac"
+
+def tee_escape(path: str) -> str:
+    return "".join(f"\\{c}" if c in "\\|[]:'" else c for c in path)
+
+def ffmpeg_pipeline(input_file, outputs, plan, probe, video=None):
+    # All outputs share one decode and one video encode, only the audio tracks differ.
+    # With video, the already encoded video of a chunked encode is copied from there.
+    input_stream = ffmpeg.input(input_file)
+    two_pass = {"pass": 2, "passlogfile": f"{outputs[0][0]}.passlog"} if plan["two_pass"] else {}
+    tracks = [[audio] if not isinstance(audio, list) else audio for _, audio in outputs]
+    streams = [audio for output_tracks in tracks for audio in output_tracks]
+    codecs = {f"c:a:{n}": audio_codec(probe, audio) for n, audio in enumerate(streams)}
+
+    if len(outputs) == 1:
+        target, output_format = outputs[0][0], {"format": "mp4", "movflags": "+faststart"}
     else:
-        output = ffmpeg.output(
-            v_stream,
-            a_stream,
-            output_file,
-            vcodec=vcodec,
-            acodec="aac",
-            movflags="+faststart",
-            format="mp4",
-            shortest=None,
-        )
+        slaves, n = [], 1
+        for (path, _), output_tracks in zip(outputs, tracks):
+            selected = ",".join(str(i) for i in [0, *range(n, n + len(output_tracks))])
+            slaves.append(f"[f=mp4:movflags=+faststart:select={selected}]{tee_escape(path)}")
+            n += len(output_tracks)
+        target, output_format = "|".join(slaves), {"format": "tee", "flags": "+global_header"}
+
+    output = ffmpeg.output(
+        scaled_video(input_stream, plan) if video is None else video.video,
+        *(audio_stream(input_stream, audio) for audio in streams),
+        target,
+        shortest=None,
+        **output_format,
+        **codecs,
+        **two_pass,
+        **(video_args(plan, encode_preset) if video is None else {"vcodec": "copy"}),
+    )
 
     return output.overwrite_output()
 
+def segment_split_pipeline(input_file, output_pattern, segment_seconds):
+    return ffmpeg.output(
+        ffmpeg.input(input_file)["v:0"],
+        output_pattern,
+        c="copy",
+        format="segment",
+        segment_time=f"{segment_seconds:.3f}",
+        segment_format="matroska",
+        reset_timestamps=1,
+    ).overwrite_output()
+
+def segment_encode_pipeline(input_file, output_file, plan, threads):
+    return ffmpeg.output(
+        scaled_video(ffmpeg.input(input_file), plan),
+        output_file,
+        format="matroska",
+        threads=threads,
+        **video_args(plan, encode_preset),
+    ).overwrite_output()
+
+def concat_list(paths: list[str]) -> bytes:
+    return "".join("file '{}'\n".format(path.replace("'", "'\\''")) for path in paths).encode()
+
+def split_pipeline(input_file, output_pattern, segment_seconds):
+    return ffmpeg.output(
+        ffmpeg.input(input_file),
+        output_pattern,
+        c="copy",
+        map=0,
+        format="segment",
+        segment_time=f"{segment_seconds:.3f}",
+        segment_format="mp4",
+        segment_format_options="movflags=+faststart",
+        reset_timestamps=1,
+    ).overwrite_output()
+
+def thumbnail_pipeline(input_file, output_file, duration):
+    return ffmpeg.output(
+        ffmpeg.input(input_file, ss=duration * 0.10).video.filter("scale", 320, 320, force_original_aspect_ratio="decrease"),
+        output_file,
+        vframes=1,
+        format="image2",
+    ).overwrite_output()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,128 @@
+import json, time, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+SPEED_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+FPS_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800)
+
+
+class Metrics:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._kinds = {}
+        self._help = {}
+        self._buckets = {}
+        self._callbacks = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, callback=None):
+        self._define(name, "counter", help, callback)
+
+    def gauge(self, name: str, help: str, callback=None):
+        self._define(name, "gauge", help, callback)
+
+    def histogram(self, name: str, help: str, buckets=TIME_BUCKETS):
+        self._define(name, "histogram", help)
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, value=1.0, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[(name, label_key(labels))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, label_key(labels))
+        buckets = self._buckets[name]
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(buckets), 0.0, 0)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> str:
+        with self._lock:
+            values = {key: (list(value[0]), *value[1:]) if isinstance(value, tuple) else value for key, value in self._values.items()}
+        lines = []
+        for name, kind in self._kinds.items():
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} {kind}")
+            if name in self._callbacks:
+                try:
+                    result = self._callbacks[name]()
+                except Exception as e:
+                    print(f"Error: metric {full}: {e}")
+                    continue
+                samples = result if isinstance(result, list) else [({}, result)]
+                values.update(((name, label_key(labels)), value) for labels, value in samples)
+            for (metric, labels), value in sorted(values.items(), key=lambda item: item[0]):
+                if metric != name:
+                    continue
+                if kind != "histogram":
+                    lines.append(f"{full}{format_labels(labels)} {format_number(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets[name], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{full}_bucket{format_labels(labels + (('le', format_number(bound)),))} {cumulative}")
+                lines.append(f"{full}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{full}_sum{format_labels(labels)} {format_number(total)}")
+                lines.append(f"{full}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+    def _define(self, name: str, kind: str, help: str, callback=None):
+        self._kinds[name] = kind
+        self._help[name] = help
+        if callback:
+            self._callbacks[name] = callback
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def event(name: str, /, **fields):
+    # One JSON object per line, so logs can be filtered and aggregated without parsing messages
+    print(json.dumps({"time": round(time.time(), 3), "event": name, **fields}, default=str), flush=True)
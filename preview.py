@@ -0,0 +1,64 @@
+import os, heapq, threading
+from collections import OrderedDict
+
+
+class SummaryCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, infohash: str):
+        with self._lock:
+            if infohash in self._entries:
+                self._entries.move_to_end(infohash)
+                return self._entries[infohash]
+
+    def put(self, infohash: str, summary: dict) -> dict:
+        with self._lock:
+            self._entries[infohash] = summary
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return summary
+
+
+def summarize(ti, video_exts: tuple, largest=5) -> dict:
+    # One pass over the file storage, without building an object per file
+    storage = ti.files()
+    count = storage.num_files()
+    multi_file = count > 1 or os.sep in storage.file_path(0)
+    root = ti.name() if multi_file else ""
+    total_size = 0
+    top = []
+    videos = []
+    files = 0
+    for index in range(count):
+        if storage.file_flags(index) & storage.flag_pad_file:
+            # Alignment padding of v2 torrents, never stored on disk
+            continue
+        files += 1
+        path, size = storage.file_path(index), storage.file_size(index)
+        total_size += size
+        if len(top) < largest:
+            heapq.heappush(top, (size, index))
+        elif top and size > top[0][0]:
+            heapq.heapreplace(top, (size, index))
+        folder, file = os.path.split(path)
+        if folder == root and file.lower().endswith(video_exts):
+            videos.append((index, file, size))
+    videos.sort(key=lambda video: video[1])
+    return {
+        "name": ti.name(),
+        "multi_file": multi_file,
+        "file_count": files,
+        "total_size": total_size,
+        "largest": [(storage.file_path(index), size) for size, index in sorted(top, reverse=True)],
+        "videos": videos,
+    }
+
+
+def selected_videos(summary: dict, torrent_data: dict) -> list:
+    # The selection is stored as the default plus the videos toggled away from it
+    select_all = torrent_data.get("select_all", True)
+    toggled = set(torrent_data.get("toggled") or [])
+    return [video for video in summary["videos"] if select_all != (video[0] in toggled)]
@@ -0,0 +1,48 @@
+import os, json, time, asyncio, ffmpeg, threading
+from collections import OrderedDict
+
+
+class ProbeCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+
+    async def probe(self, path: str) -> dict:
+        key = self._key(path)
+        result = self._lookup(key)
+        if result is None:
+            self.misses += 1
+            start = time.monotonic()
+            args = ["ffprobe", "-show_format", "-show_streams", "-of", "json", path]
+            process = await asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+            out, err = await process.communicate()
+            self.seconds += time.monotonic() - start
+            if process.returncode != 0:
+                raise ffmpeg.Error("ffprobe", out, err)
+            result = self._store(key, json.loads(out.decode("utf-8")))
+        else:
+            self.hits += 1
+        return result
+
+    def _key(self, path: str):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+    def _store(self, key, result: dict) -> dict:
+        with self._lock:
+            self._entries[key] = result
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
@@ -0,0 +1,60 @@
+import asyncio, time
+from telegram.error import BadRequest, RetryAfter
+
+EDITS_PER_SECOND = 20
+
+
+class ProgressReporter:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending = {}
+        self._sent = {}
+        self._flushers = {}
+        self._next_chat_edit = {}
+        self._next_edit = 0.0
+
+    def update(self, message, text: str):
+        key = (message.chat_id, message.message_id)
+        if self._sent.get(key) == text:
+            self._pending.pop(key, None)
+            return
+        self._pending[key] = (message, text)
+        flusher = self._flushers.get(message.chat_id)
+        if not flusher or flusher.done():
+            self._flushers[message.chat_id] = asyncio.create_task(self._flush(message.chat_id))
+
+    def finish(self, message):
+        key = (message.chat_id, message.message_id)
+        self._pending.pop(key, None)
+        self._sent.pop(key, None)
+
+    async def _flush(self, chat_id):
+        while keys := [key for key in self._pending if key[0] == chat_id]:
+            await self._wait_turn(chat_id)
+            if keys[0] not in self._pending:
+                continue
+            message, text = self._pending.pop(keys[0])
+            try:
+                await message.edit_text(text)
+                self._sent[keys[0]] = text
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+                self._next_chat_edit[chat_id] = time.monotonic() + delay
+                self._pending.setdefault(keys[0], (message, text))
+            except BadRequest as e:
+                if "not modified" in str(e):
+                    self._sent[keys[0]] = text
+                else:
+                    print(f"Error: {e}")
+            except Exception as e:
+                print(f"Error: {e}")
+        self._flushers.pop(chat_id, None)
+
+    async def _wait_turn(self, chat_id):
+        now = time.monotonic()
+        start = max(now, self._next_chat_edit.get(chat_id, 0.0), self._next_edit)
+        self._next_chat_edit[chat_id] = start + self.interval
+        self._next_edit = start + 1 / EDITS_PER_SECOND
+        if start > now:
+            await asyncio.sleep(start - now)
@@ -0,0 +1,78 @@
+import asyncio, itertools
+from contextlib import asynccontextmanager
+
+# Priority classes, lower runs first
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+
+class Scheduler:
+    def __init__(self, workers: int, reserved=0):
+        self.workers = max(1, workers)
+        # Extra slots only interactive work may take, so a sample never waits for a full encode to finish
+        self.reserved = max(0, reserved)
+        self.running = 0
+        self._users = {}
+        self._served = {}
+        self._waiting = []
+        self._order = itertools.count()
+
+    def waiting(self) -> dict:
+        counts = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _, _ in self._waiting:
+            counts[PRIORITY_NAMES[priority]] += 1
+        return counts
+
+    @asynccontextmanager
+    async def slot(self, priority=BULK, user=None):
+        await self.acquire(priority, user)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+    async def acquire(self, priority=BULK, user=None):
+        if self.running < self._limit(priority) and not any(waiting[0] <= priority for waiting in self._waiting):
+            self._start(user)
+            return
+        waiter = (priority, next(self._order), user, asyncio.get_running_loop().create_future())
+        self._waiting.append(waiter)
+        try:
+            await waiter[3]
+        except asyncio.CancelledError:
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+            elif not waiter[3].cancelled():
+                # The slot was handed over just before the cancellation
+                self.release(user)
+            raise
+
+    def release(self, user=None):
+        self.running -= 1
+        self._users[user] -= 1
+        if not self._users[user]:
+            del self._users[user]
+        self._wake()
+
+    def _limit(self, priority: int) -> int:
+        return self.workers + (self.reserved if priority == INTERACTIVE else 0)
+
+    def _start(self, user):
+        self.running += 1
+        self._users[user] = self._users.get(user, 0) + 1
+        self._served[user] = next(self._order)
+
+    def _wake(self):
+        while True:
+            ready = [waiter for waiter in self._waiting if self.running < self._limit(waiter[0])]
+            if not ready:
+                return
+            # Highest class first, then the user with the fewest running jobs who was served longest ago,
+            # so one big pack cannot starve the others
+            waiter = min(ready, key=lambda waiter: (waiter[0], self._users.get(waiter[2], 0), self._served.get(waiter[2], -1), waiter[1]))
+            self._waiting.remove(waiter)
+            if waiter[3].done():
+                continue
+            self._start(waiter[2])
+            waiter[3].set_result(None)
@@ -0,0 +1,40 @@
+import os, fcntl
+
+# ioctl of linux/fs.h that shares the extents of a file on btrfs, XFS and other copy-on-write filesystems
+FICLONE = 0x40049409
+
+
+def is_faststart(path: str) -> bool:
+    # Telegram streams an MP4 only if its moov index comes before the media data
+    with open(path, "rb") as f:
+        while len(header := f.read(8)) == 8:
+            size, kind = int.from_bytes(header[:4], "big"), header[4:]
+            if kind == b"moov":
+                return True
+            if kind == b"mdat":
+                return False
+            if size == 1:
+                size = int.from_bytes(f.read(8), "big") - 8
+            if size < 8:
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+    return False
+
+
+def link_file(source: str, target: str):
+    # Stage without writing a copy: a hard link, else a reflink, else None and the caller converts as usual
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return "reflink"
+    except OSError:
+        if os.path.lexists(target):
+            os.remove(target)
+    return None
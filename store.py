@@ -0,0 +1,128 @@
+import json, sqlite3, threading, time
+
+DOWNLOAD = "download"
+READY = "ready"
+UPLOAD = "upload"
+DONE = "done"
+
+
+class JobStore:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, user_id INTEGER, chat_id INTEGER, name TEXT, stage TEXT, "
+            "downloaded INTEGER DEFAULT 0, torrent_path TEXT, download_dir TEXT, resume_data BLOB, "
+            "data TEXT DEFAULT '{}', uploaded TEXT DEFAULT '[]', updated REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage, updated)")
+        self._db.commit()
+
+    def add(self, job_id, user_id, chat_id, name, torrent_path, download_dir, data: dict):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (id, user_id, chat_id, name, stage, torrent_path, download_dir, data, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, user_id, chat_id, name, DOWNLOAD, torrent_path, download_dir, json.dumps(data), time.time()),
+            )
+            self._db.commit()
+
+    def update(self, job_id, **fields):
+        if "data" in fields:
+            fields["data"] = json.dumps(fields["data"])
+        if "uploaded" in fields:
+            fields["uploaded"] = json.dumps(sorted(fields["uploaded"]))
+        fields["updated"] = time.time()
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock:
+            self._db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            self._db.commit()
+
+    def get(self, job_id) -> dict:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return self._record(row) if row else None
+
+    def unfinished(self) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM jobs WHERE stage IN (?, ?, ?) ORDER BY updated", (DOWNLOAD, READY, UPLOAD)
+            ).fetchall()
+            return [self._record(row) for row in rows]
+
+    def prune(self, max_age: float):
+        # Finished jobs are kept for a while, their remove prompt still reads the download folder
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE stage = ? AND updated < ?", (DONE, time.time() - max_age))
+            self._db.commit()
+
+    def _record(self, row) -> dict:
+        record = dict(row)
+        record["data"] = json.loads(record["data"] or "{}")
+        record["uploaded"] = set(json.loads(record["uploaded"] or "[]"))
+        return record
+
+
+class UploadCache:
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "infohash TEXT, file_index INTEGER, audio TEXT, settings TEXT, files TEXT, used REAL, "
+            "PRIMARY KEY (infohash, file_index, audio, settings))"
+        )
+        self._db.commit()
+
+    def get(self, infohash, file_index, audio, settings) -> list:
+        key = (infohash, file_index, str(audio), settings)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT files FROM uploads WHERE infohash = ? AND file_index = ? AND audio = ? AND settings = ?", key
+            ).fetchone()
+            if not row:
+                return None
+            self._db.execute(
+                "UPDATE uploads SET used = ? WHERE infohash = ? AND file_index = ? AND audio = ? AND settings = ?",
+                (time.time(), *key),
+            )
+            self._db.commit()
+            return json.loads(row[0])
+
+    def put(self, infohash, file_index, audio, settings, files: list):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                (infohash, file_index, str(audio), settings, json.dumps(files), time.time()),
+            )
+            self._db.execute(
+                "DELETE FROM uploads WHERE rowid NOT IN (SELECT rowid FROM uploads ORDER BY used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+
+    def cached_files(self, infohash, settings) -> set:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT DISTINCT file_index FROM uploads WHERE infohash = ? AND settings = ?", (infohash, settings)
+            ).fetchall()
+        return {file_index for file_index, in rows}
+
+    def complete(self, infohash, file_indexes: list, settings) -> dict:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT file_index, audio, files FROM uploads WHERE infohash = ? AND settings = ? ORDER BY used DESC",
+                (infohash, settings),
+            ).fetchall()
+        by_audio = {}
+        for file_index, audio, files in rows:
+            by_audio.setdefault(audio, {})[file_index] = json.loads(files)
+        for uploads in by_audio.values():
+            if all(index in uploads for index in file_indexes):
+                return {index: uploads[index] for index in file_indexes}
+        return None
@@ -0,0 +1,138 @@
+import asyncio
+import libtorrent as lt
+
+DONT_DOWNLOAD = 0
+DEFAULT_PRIORITY = 4
+TOP_PRIORITY = 7
+
+
+class TorrentSession:
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self._session: lt.session = None
+        self._resume_waiters = []
+        self._users = {}
+
+    @property
+    def session(self) -> lt.session:
+        if self._session is None:
+            self._session = lt.session(self.settings)
+        return self._session
+
+    def add(self, ti: lt.torrent_info, save_path: str, resume_data: bytes = None) -> lt.torrent_handle:
+        handle = self.session.find_torrent(ti.info_hashes().get_best())
+        if not handle.is_valid():
+            params = lt.read_resume_data(resume_data) if resume_data else lt.add_torrent_params()
+            params.ti = params.ti or ti
+            params.save_path = save_path
+            params.storage_mode = lt.storage_mode_t.storage_mode_sparse
+            params.file_priorities = [DONT_DOWNLOAD] * ti.num_files()
+            handle = self.session.add_torrent(params)
+        self._users[handle] = self._users.get(handle, 0) + 1
+        return handle
+
+    async def fetch_metadata(self, uri: str, save_path: str, timeout=60.0, interval=0.5) -> lt.torrent_handle:
+        params = lt.parse_magnet_uri(uri)
+        handle = self.session.find_torrent(params.info_hashes.get_best())
+        added = not handle.is_valid()
+        if added:
+            params.save_path = save_path
+            params.storage_mode = lt.storage_mode_t.storage_mode_sparse
+            # Upload mode keeps libtorrent from downloading every file as soon as the metadata arrives
+            params.flags |= lt.torrent_flags.upload_mode
+            handle = self.session.add_torrent(params)
+        self._users[handle] = self._users.get(handle, 0) + 1
+        try:
+            async with asyncio.timeout(timeout):
+                while not handle.status().has_metadata:
+                    await asyncio.sleep(interval)
+        except BaseException:
+            self.remove(handle)
+            raise
+        if added:
+            handle.prioritize_files([DONT_DOWNLOAD] * handle.torrent_file().num_files())
+            handle.unset_flags(lt.torrent_flags.upload_mode)
+        return handle
+
+    def want(self, handle: lt.torrent_handle, indexes, top=None):
+        # The handle may be shared with another job, so only ever raise priorities
+        priorities = handle.get_file_priorities()
+        for index in indexes:
+            priorities[index] = max(priorities[index], TOP_PRIORITY if index == top else DEFAULT_PRIORITY)
+        handle.prioritize_files(priorities)
+
+    def remove(self, handle: lt.torrent_handle, delete_files=False):
+        if not handle.is_valid():
+            return
+        self._users[handle] = self._users.get(handle, 1) - 1
+        if self._users[handle] > 0:
+            return
+        del self._users[handle]
+        self.session.remove_torrent(handle, lt.session.delete_files if delete_files else 0)
+
+    async def resume_data(self, handle: lt.torrent_handle, timeout=10.0) -> bytes:
+        if not handle.is_valid():
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._resume_waiters.append((handle, future))
+        handle.save_resume_data(lt.torrent_handle.save_info_dict)
+        try:
+            async with asyncio.timeout(timeout):
+                while not future.done():
+                    self._dispatch_alerts()
+                    if not future.done():
+                        await asyncio.sleep(0.1)
+            return future.result()
+        except TimeoutError:
+            return None
+        finally:
+            self._resume_waiters.remove((handle, future))
+
+    def _dispatch_alerts(self):
+        for alert in self.session.pop_alerts():
+            if isinstance(alert, lt.save_resume_data_alert):
+                data = lt.write_resume_data_buf(alert.params)
+            elif isinstance(alert, lt.save_resume_data_failed_alert):
+                data = None
+            else:
+                continue
+            for handle, future in self._resume_waiters:
+                if handle == alert.handle and not future.done():
+                    future.set_result(data)
+
+    async def download(self, handle: lt.torrent_handle, order=(), on_file_complete=None, on_status=None, interval=1.0):
+        files = handle.torrent_file().files()
+        pending = list(order)
+        self.want(handle, pending)
+        try:
+            while True:
+                # Priorities are applied asynchronously and read back stale until then, so every update
+                # carries all wanted files, and a torrent with nothing wanted yet must not count as finished
+                priorities = handle.get_file_priorities()
+                if pending and priorities[pending[0]] != TOP_PRIORITY:
+                    self.want(handle, order, pending[0])
+                status = handle.status()
+                finished = status.is_finished and all(priorities[index] != DONT_DOWNLOAD for index in order)
+                if on_status: on_status(status)
+                progress = handle.file_progress(flags=lt.torrent_handle.piece_granularity)
+                while pending and (finished or progress[pending[0]] == files.file_size(pending[0])):
+                    index = pending.pop(0)
+                    if on_file_complete: on_file_complete(index)
+                for index in [i for i in pending if progress[i] == files.file_size(i)]:
+                    pending.remove(index)
+                    if on_file_complete: on_file_complete(index)
+                if finished:
+                    break
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            self.remove(handle)
+            raise
+
+
+def torrent_bytes(handle: lt.torrent_handle) -> bytes:
+    data = {b"info": lt.bdecode(handle.torrent_file().info_section())}
+    trackers = [[tracker["url"].encode()] for tracker in handle.trackers()]
+    if trackers:
+        data[b"announce"] = trackers[0][0]
+        data[b"announce-list"] = trackers
+    return lt.bencode(data)
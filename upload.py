@@ -0,0 +1,59 @@
+import os, asyncio, random
+from pathlib import Path
+from collections import defaultdict
+from telegram.error import BadRequest, Forbidden, InvalidToken, RetryAfter
+
+MAX_BACKOFF = 60.0
+
+
+class Uploader:
+    def __init__(self, per_chat: int, retries: int, backoff: float):
+        self.retries = max(1, retries)
+        self.backoff = backoff
+        self._chats = defaultdict(lambda: asyncio.Semaphore(max(1, per_chat)))
+        self.retried = {"flood_wait": 0, "error": 0}
+
+    def slot(self, chat_id) -> asyncio.Semaphore:
+        return self._chats[str(chat_id)]
+
+    async def send(self, target, *args, **kwargs):
+        return await retry(target, *args, retries=self.retries, backoff=self.backoff, on_retry=self._retried, **kwargs)
+
+    def _retried(self, error: Exception):
+        self.retried["flood_wait" if isinstance(error, RetryAfter) else "error"] += 1
+
+
+async def retry(target, *args, retries=3, backoff=1.0, on_retry=None, **kwargs):
+    for attempt in range(retries):
+        try:
+            return await target(*args, **kwargs)
+        except (BadRequest, Forbidden, InvalidToken):
+            raise
+        except Exception as e:
+            print(f"Error: {e}")
+            if attempt == retries - 1:
+                raise
+            if isinstance(e, RetryAfter):
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            else:
+                delay = min(MAX_BACKOFF, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if on_retry:
+                on_retry(e)
+            await asyncio.sleep(delay)
+
+
+def parse_path_map(text: str) -> list[tuple[str, str]]:
+    mapping = []
+    for item in (text or "").split(","):
+        local, _, server = item.partition("=")
+        if local.strip() and server.strip():
+            mapping.append((os.path.realpath(local.strip()), server.strip().rstrip("/") or "/"))
+    return mapping
+
+
+def server_uri(path: str, mapping: list[tuple[str, str]]) -> str:
+    path = os.path.realpath(path)
+    for local, server in mapping:
+        if os.path.commonpath([path, local]) == local:
+            return Path(server, os.path.relpath(path, local)).as_uri()
+    return None